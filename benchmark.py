@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the data grab offline.
+
+The pipeline (`python -m uk_coronavirus_deaths`) is run against a local corpus
+of source files, replayed through its own HTTP cache in offline mode
+(`HTTP_CACHE_OFFLINE=1`), so no network access is needed. The corpus is either:
+
+- a synthetic one, generated to look like the NHS, ONS and PHE files, at a
+  chosen scale (number of daily workbooks, trusts, ONS weeks and areas, PHE
+  days); or
+- a recorded one: the `.http_cache` directory left behind by a live run.
+
+Each run starts from an empty database. The per-stage metrics the pipeline
+records (see `run_metrics.json`) are reported as throughput: files (for the
+stages that handle one file at a time), rows and MB per second for each stage,
+and the most the RSS grew over any one run of it, along with the end-to-end
+time.
+
+    python benchmark.py                          # the baseline preset
+    python benchmark.py --preset all             # every preset
+    python benchmark.py --dailies 1000 --trusts 230
+    python benchmark.py --recorded .http_cache
+"""
+
+import argparse
+import datetime as dt
+import hashlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+NHS_PAGE = 'https://www.england.nhs.uk/statistics/statistical-work-areas/covid-19-daily-deaths/'
+ONS_WEEKLY_PAGE = 'https://www.ons.gov.uk/peoplepopulationandcommunity/birthsdeathsandmarriages/deaths/datasets/weeklyprovisionalfiguresondeathsregisteredinenglandandwales'
+ONS_REG_PAGE = 'https://www.ons.gov.uk/peoplepopulationandcommunity/healthandsocialcare/causesofdeath/datasets/deathregistrationsandoccurrencesbylocalauthorityandhealthboard'
+PHE_CASES = 'https://coronavirus.data.gov.uk/downloads/csv/coronavirus-cases_latest.csv'
+PHE_DEATHS = 'https://coronavirus.data.gov.uk/downloads/csv/coronavirus-deaths_latest.csv'
+
+REGIONS = ['East of England', 'London', 'Midlands', 'North East and Yorkshire',
+           'North West', 'South East', 'South West']
+AGE_GROUPS = ['0 - 19', '20 - 39', '40 - 59', '60 - 79', '80+']
+
+# Roughly the size of the real thing, and scaled up versions of it
+presets = {'baseline': {'dailies': 30, 'trusts': 230},
+           'many-dailies': {'dailies': 1000, 'trusts': 230},
+           'many-trusts': {'dailies': 30, 'trusts': 2300}}
+
+
+# ## Synthetic corpus
+
+def nhs_sheet(kind, published, dates, trusts, totals=False):
+    """A sheet laid out like the NHS daily and totals workbooks."""
+    if kind == 'trust':
+        index = ['NHS England Region', 'Code', 'Name']
+        body = [[REGIONS[i % len(REGIONS)], f'R{i:04d}', f'TRUST {i} NHS FOUNDATION TRUST']
+                for i in range(trusts)]
+    elif kind == 'age':
+        index = ['Age group']
+        body = [[a] for a in AGE_GROUPS]
+    else:
+        index = ['NHS England Region']
+        body = [[r] for r in REGIONS]
+    header = [None] + index + (['Up to 01-Mar-20'] if totals else []) + \
+             ['Awaiting verification'] + list(dates) + ['Total']
+    width = len(header)
+    pad = lambda row: row + [None] * (width - len(row))
+    rows = [[None] * width for _ in range(12)]
+    rows[2] = pad([None, 'Published:', published])
+    rows += [header, [None] * width, pad([None, 'England'])]
+    rng = np.random.default_rng(len(dates) + trusts)
+    for b in body:
+        values = rng.integers(0, 5, len(dates)).tolist()
+        rows.append([None] + b + ([0] if totals else []) + [1] + values + [sum(values) + 1])
+    rows += [[None] * width, pad([None, 'Notes:']), pad([None, 'Some notes'])]
+    return pd.DataFrame(rows)
+
+def xlsx(sheets):
+    """Write some sheets to an .xlsx workbook."""
+    b = io.BytesIO()
+    with pd.ExcelWriter(b, engine='openpyxl') as writer:
+        for name, df in sheets.items():
+            df.to_excel(writer, sheet_name=name, header=False, index=False)
+    return b.getvalue()
+
+def nhs_daily(day, trusts):
+    published = dt.datetime(2020, 4, 1) + dt.timedelta(days=day)
+    dates = [published - dt.timedelta(days=k) for k in range(5, 0, -1)]
+    return xlsx({'Contents': pd.DataFrame([['Contents']]),
+                 'COVID19 daily deaths by region': nhs_sheet('region', published, dates, trusts),
+                 'COVID19 daily deaths by age': nhs_sheet('age', published, dates, trusts),
+                 'COVID19 daily deaths by trust': nhs_sheet('trust', published, dates, trusts)})
+
+def nhs_totals(days, trusts):
+    published = (dt.datetime(2020, 3, 1) + dt.timedelta(days=days)).strftime('%d %B %Y')
+    dates = [dt.datetime(2020, 3, 1) + dt.timedelta(days=k) for k in range(days)]
+    return xlsx({'Contents': pd.DataFrame([['Contents']]),
+                 'Tab1 Deaths by region': nhs_sheet('region', published, dates, trusts, totals=True),
+                 'Tab3 Deaths by age': nhs_sheet('age', published, dates, trusts, totals=True),
+                 'Tab4 Deaths by trust': nhs_sheet('trust', published, dates, trusts, totals=True)})
+
+def ons_weekly(weeks):
+    """A workbook laid out like the ONS weekly deaths workbook."""
+    width = weeks + 4
+    ended = [dt.datetime(2020, 1, 3) + dt.timedelta(weeks=k) for k in range(weeks)]
+    rows = [[None] * width for _ in range(4)]
+    rows.append(['Week number', None] + list(range(1, weeks + 1)) + [None, None])
+    rows.append([None, 'Week ended'] + ended + [None, 'Year to date'])
+    ages = ['Under 1 year', '1-14', '15-44', '45-64', '65-74', '75-84', '85-89', '90+']
+    for group in ['Persons', 'Males', 'Females']:
+        rows.append([None] * width)
+        rows.append([f'{group} 3'] + [None] * (width - 1))
+        rows.append(['Deaths by age group'] + [None] * (width - 1))
+        for age in ages:
+            rows.append([None, age] + (np.arange(weeks) + len(age)).tolist() + [None, 0])
+    sheet = pd.DataFrame(rows)
+    return xlsx({'Contents': pd.DataFrame([['Contents']]),
+                 'Covid-19 - Weekly registrations': sheet,
+                 'Covid-19 - Weekly occurrences': sheet,
+                 'Weekly figures 2020': sheet})
+
+def ons_registrations(areas, weeks):
+    """A workbook laid out like the ONS death registrations and occurrences workbook."""
+    def sheet(title):
+        rows = [['Contents'] + [None] * 6, [title] + [None] * 6, [None] * 7,
+                ['Area code', 'Geography type', 'Area name', 'Cause of death', 'Week number',
+                 'Place of death', 'Number of deaths']]
+        for area in range(areas):
+            for week in range(1, weeks + 1):
+                for cause in ['COVID 19', 'All causes']:
+                    for place in ['Home', 'Hospital', 'Care home']:
+                        rows.append([f'E0{area:07d}', 'Local Authority', f'Area {area}', cause,
+                                     week, place, (area + week) % 13])
+        return pd.DataFrame(rows)
+    return xlsx({
+        'Registrations - All data': sheet('Deaths (numbers) by local authority and cause of death, registered up to the 1st May 2020, England and Wales'),
+        'Occurrences - All data': sheet('Deaths (numbers) by local authority and cause of death, for deaths that occurred up to 24 April but were registered up to 2 May 2020, England and Wales')})
+
+def phe_csv(areas, days, date_column, columns):
+    """A CSV laid out like the PHE cases and deaths downloads."""
+    day = np.tile(np.arange(days), areas)
+    area = np.repeat(np.arange(areas), days)
+    df = pd.DataFrame({'Area name': [f'Area {a}' for a in area],
+                       'Area code': [f'E0{a:07d}' for a in area],
+                       'Area type': 'Upper tier local authority',
+                       date_column: (pd.Timestamp('2020-03-01') + pd.to_timedelta(day, 'D')).strftime('%Y-%m-%d')})
+    for i, c in enumerate(columns):
+        df[c] = (day + area + i) % 17
+    return df.to_csv(index=False).encode()
+
+def synthetic_corpus(dailies=30, trusts=230, weeks=20, areas=350, phe_days=120):
+    """Generate the source files, as a dict mapping their URLs to their bodies."""
+    files, links = {}, []
+    for day in range(dailies):
+        published = dt.date(2020, 4, 1) + dt.timedelta(days=day)
+        url = f'https://www.england.nhs.uk/coronavirus-daily-deaths-{day}.xlsx'
+        files[url] = nhs_daily(day, trusts)
+        links.append((f'COVID 19 daily announced deaths {published.day} {published:%B %Y}', url))
+    latest = dt.date(2020, 4, 1) + dt.timedelta(days=dailies - 1)
+    for suffix in ['', ' weekly tables']:
+        url = f'https://www.england.nhs.uk/coronavirus-total-deaths{suffix.replace(" ", "-")}.xlsx'
+        files[url] = nhs_totals(dailies + 31, trusts)
+        links.append((f'COVID 19 total announced deaths {latest.day} {latest:%B %Y}{suffix}', url))
+    files[NHS_PAGE] = ('<html><body><article class="rich-text">' +
+                       ''.join(f'<p><a href="{url}">{text}</a></p>' for text, url in links) +
+                       '</article></body></html>').encode()
+    files[ONS_WEEKLY_PAGE] = b'<html><body><a href="/file?uri=/weekly.xlsx">Download Deaths registered weekly in England and Wales</a></body></html>'
+    files['https://www.ons.gov.uk/file?uri=/weekly.xlsx'] = ons_weekly(weeks)
+    files[ONS_REG_PAGE] = b'<html><body><a href="/file?uri=/lahtable.xlsx">Download Death registrations and occurrences by local authority and health board</a></body></html>'
+    files['https://www.ons.gov.uk/file?uri=/lahtable.xlsx'] = ons_registrations(areas, weeks)
+    files[PHE_CASES] = phe_csv(areas, phe_days, 'Specimen date',
+                               ['Daily lab-confirmed cases', 'Previously reported daily cases',
+                                'Change in daily cases', 'Cumulative lab-confirmed cases'])
+    files[PHE_DEATHS] = phe_csv(areas, phe_days, 'Reporting date',
+                                ['Daily change in deaths', 'Cumulative deaths'])
+    return files
+
+def write_cache(files, cache_dir):
+    """Write source files to a directory in the format used by the pipeline's HTTP cache."""
+    os.makedirs(cache_dir, exist_ok=True)
+    for url, body in files.items():
+        path = os.path.join(cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest())
+        html = body.lstrip().startswith(b'<html')
+        meta = {'url': url, 'final_url': url, 'encoding': 'utf-8' if html else None,
+                'etag': None, 'last_modified': None,
+                'headers': {'Content-Type': 'text/html' if html else 'application/octet-stream',
+                            'Content-Length': str(len(body))}}
+        with open(f'{path}.body', 'wb') as f:
+            f.write(body)
+        with open(f'{path}.json', 'w') as f:
+            json.dump(meta, f)
+
+
+# ## Running the pipeline
+
+def run_pipeline(cache_dir, env=None):
+    """Run the pipeline from scratch against a cache directory, offline.
+
+    Returns the end-to-end time and the pipeline's run metrics summary."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Work on a copy of the cache, so the corpus is left as it is
+        cache = os.path.join(work_dir, '.http_cache')
+        shutil.copytree(cache_dir, cache)
+        run_env = {**os.environ, 'HTTP_CACHE_DIR': cache, 'HTTP_CACHE_OFFLINE': '1',
+                   'RUN_METRICS_JSON': os.path.join(work_dir, 'run_metrics.json'),
+                   'PYTHONPATH': os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])),
+                   **(env or {})}
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-m', 'uk_coronavirus_deaths'], cwd=work_dir, env=run_env,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        seconds = time.perf_counter() - start
+        if result.returncode:
+            sys.stdout.write(result.stdout.decode('utf-8', 'replace')[-5000:])
+            raise RuntimeError(f"The pipeline failed (exit code {result.returncode})")
+        with open(run_env['RUN_METRICS_JSON']) as f:
+            summary = json.load(f)
+        summary['db_mb'] = os.path.getsize(os.path.join(work_dir, 'nhs_dailies.db')) / 1024 ** 2
+    return seconds, summary
+
+# The stages that run once for each source file (or page), so that their count is a number of files
+file_stages = ['scrape', 'download', 'parse_cache', 'read_excel', 'read_csv', 'stream_csv', 'cleaner']
+
+def throughput(summary):
+    """Tabulate the throughput of each stage from a run metrics summary."""
+    stages = pd.DataFrame.from_dict(summary['stages'], orient='index')
+    seconds = stages['seconds'].where(stages['seconds'] > 0)
+    report = pd.DataFrame({'count': stages['count'], 'seconds': stages['seconds'],
+                           'files/s': stages['count'] / seconds,
+                           'rows/s': stages['rows'] / seconds,
+                           'MB/s': stages['bytes'] / 1024 ** 2 / seconds,
+                           'max RSS growth MB': stages.get('rss_growth_mb')})
+    # Rates that don't apply to a stage (it doesn't handle files, or count rows or bytes) are left blank
+    report.loc[~stages.index.isin(file_stages), 'files/s'] = np.nan
+    report.loc[stages['rows'] == 0, 'rows/s'] = np.nan
+    report.loc[stages['bytes'] == 0, 'MB/s'] = np.nan
+    return report.sort_values('seconds', ascending=False)
+
+def benchmark(name, cache_dir, runs=1, env=None):
+    """Run the pipeline against a corpus, and report on the fastest run."""
+    results = [run_pipeline(cache_dir, env) for _ in range(runs)]
+    seconds, summary = min(results, key=lambda result: result[0])
+    print(f"\n## {name}\n")
+    print(f"End to end: {seconds:.2f}s (pipeline {summary['seconds']:.2f}s), "
+          f"peak RSS {summary['peak_rss_mb']:.0f} MB, db {summary['db_mb']:.1f} MB")
+    print(throughput(summary).to_string(float_format=lambda v: f'{v:,.2f}'))
+    return {'name': name, 'seconds': seconds, **summary}
+
+def corpus_dir(root, scale):
+    """Get the directory for a synthetic corpus, generating it if we haven't already."""
+    path = os.path.join(root, '_'.join(f'{k}{v}' for k, v in sorted(scale.items())))
+    if not os.path.exists(path):
+        print(f"Generating corpus: {scale}")
+        write_cache(synthetic_corpus(**scale), f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+    return path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--preset', choices=[*presets, 'all'], default='baseline')
+    parser.add_argument('--dailies', type=int, help="number of daily workbooks")
+    parser.add_argument('--trusts', type=int, help="number of trusts in each NHS workbook")
+    parser.add_argument('--weeks', type=int, default=20, help="number of ONS weeks")
+    parser.add_argument('--areas', type=int, default=350, help="number of ONS and PHE areas")
+    parser.add_argument('--recorded', help="benchmark against a recorded HTTP cache directory instead")
+    parser.add_argument('--corpus-root', default='.benchmark', help="where to keep generated corpora")
+    parser.add_argument('--runs', type=int, default=1, help="report the fastest of this many runs")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    if args.recorded:
+        corpora = {f'recorded: {args.recorded}': args.recorded}
+    elif args.dailies or args.trusts:
+        scale = {'dailies': args.dailies or 30, 'trusts': args.trusts or 230}
+        corpora = {f'dailies={scale["dailies"]} trusts={scale["trusts"]}': scale}
+    else:
+        names = list(presets) if args.preset == 'all' else [args.preset]
+        corpora = {name: presets[name] for name in names}
+
+    results = []
+    for name, corpus in corpora.items():
+        if isinstance(corpus, dict):
+            corpus = corpus_dir(args.corpus_root, {**corpus, 'weeks': args.weeks, 'areas': args.areas})
+        results.append(benchmark(name, corpus, args.runs))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+"""Grab the UK coronavirus deaths data published by NHS England, the ONS and PHE into a SQLite db.
+
+There's a module for each of the feeds (`nhs`, `ons_weekly`, `ons_registrations` and `phe`),
+and `pipeline.run()` runs them all. Submodules are imported when they're first used, so
+`import uk_coronavirus_deaths` is cheap and importing one feed doesn't pull in the others.
+"""
+import importlib
+
+__all__ = ['aggregates', 'cli', 'dates', 'db', 'discovery', 'http_cache', 'indexes', 'metrics',
+           'nhs', 'normalised', 'ons_registrations', 'ons_weekly', 'parquet_export', 'parse_cache',
+           'phe', 'pipeline', 'publish', 'sheets', 'sources']
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
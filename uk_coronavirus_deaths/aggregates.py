@@ -0,0 +1,116 @@
+"""Reporting lag aggregates.
+
+Rather than pulling the raw rows into pandas every time we want to look at reporting lags, the
+lag distributions of the daily announcements are materialised in the database:
+
+- `nhs_lag_trust`, `nhs_lag_region` and `nhs_lag_age` hold, for each trust, region or age
+  group, the number of deaths announced at each reporting lag (in days), along with the
+  cumulative number and share of its deaths reported by that lag;
+- `nhs_lag_trust_completeness` etc. hold each trust's (region's, age group's) total deaths, and
+  the lags by which 50%, 90% and 95% of them had been reported.
+
+The histograms are updated incrementally: only the dailies ingested since they were last
+updated are added to them. Which dailies have been added is noted in `nhs_lag_sources`, by
+their ledger reference and the rowids they were written to, so a daily that's been replaced
+since (a revised report, say) is spotted, and the histograms are then rebuilt from scratch. The
+cumulative curves and completeness percentiles are recalculated from the histograms, which are
+small.
+"""
+import json
+
+from . import db, normalised
+from .db import nhs_index_columns, tables_written
+from .metrics import stage
+
+lag_percentiles = [50, 90, 95]
+
+def daily_rowids(table):
+    """The rowids each daily in the ledger was written to in a table, as JSON, by reference."""
+    rowids = {}
+    for reference, tables in db.DB.execute("SELECT reference, tables FROM processed WHERE tables IS NOT NULL"):
+        ranges = json.loads(tables).get(table)
+        if ranges:
+            rowids[reference] = json.dumps(ranges)
+    return rowids
+
+def merged_ranges(rowids):
+    """Merge the rowid ranges of some dailies into as few ranges as possible."""
+    merged = []
+    for start, end in sorted(r for ranges in rowids for r in json.loads(ranges)):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def update_lag_aggregates(kind):
+    """Add any new dailies to the reporting lag aggregates for a trust, region or age table."""
+    source = f'nhs_dailies_{kind}'
+    if source not in db.DB.table_names() + db.DB.view_names():
+        return
+    # The rows are in the table itself, or in normalised storage, its fact table
+    rows_table = source if source in db.DB.table_names() else f'{source}_facts'
+    if rows_table != source:
+        normalised.update_view(source)
+    histogram = f'nhs_lag_{kind}'
+    columns = nhs_index_columns[kind]
+    keys_sql = ', '.join(f'[{c}]' for c in columns)
+    if histogram not in db.DB.table_names():
+        columns_sql = ', '.join(f'[{c}] {t}' for c, t in columns.items())
+        db.DB.execute(f"""CREATE TABLE [{histogram}] ({columns_sql}, [lag] INTEGER, [deaths] INTEGER,
+                          [cumulative_deaths] INTEGER, [cumulative_share] REAL, UNIQUE ({keys_sql}, [lag]))""")
+        db.DB.execute("DELETE FROM nhs_lag_sources WHERE kind = ?", [kind])
+    current = daily_rowids(rows_table)
+    added = dict(db.DB.execute("SELECT reference, rowids FROM nhs_lag_sources WHERE kind = ?", [kind]).fetchall())
+    before = db.DB.conn.total_changes
+    # Start again if a daily has been replaced (or removed) since it was added, or we don't know
+    # which dailies have been
+    if not added or any(current.get(reference) != rowids for reference, rowids in added.items()):
+        db.DB.execute(f"DELETE FROM [{histogram}]")
+        db.DB.execute("DELETE FROM nhs_lag_sources WHERE kind = ?", [kind])
+        added = {}
+    new = {reference: rowids for reference, rowids in current.items() if reference not in added}
+    if not new:
+        chunks = []
+    elif not added:
+        # Every row is new, so there's no need to pick them out
+        chunks = [[]]
+    else:
+        ranges = merged_ranges(new.values())
+        chunks = [ranges[i:i + 400] for i in range(0, len(ranges), 400)]
+    not_null = ' AND '.join(f'[{c}] IS NOT NULL' for c in [*columns, 'lag', 'value'])
+    for chunk in chunks:
+        new_rows = ' OR '.join('[rowid] BETWEEN ? AND ?' for _ in chunk) or 'true'
+        db.DB.execute(f"""INSERT INTO [{histogram}] ({keys_sql}, [lag], [deaths])
+                          SELECT {keys_sql}, [lag], SUM([value]) FROM [{source}]
+                          WHERE ({new_rows}) AND {not_null} GROUP BY {keys_sql}, [lag]
+                          ON CONFLICT ({keys_sql}, [lag]) DO UPDATE SET [deaths] = [deaths] + excluded.[deaths]""",
+                      [bound for r in chunk for bound in r])
+    db.DB.conn.executemany("INSERT INTO nhs_lag_sources VALUES (?, ?, ?)",
+                           [(kind, reference, rowids) for reference, rowids in new.items()])
+    if db.DB.conn.total_changes == before and f'{histogram}_completeness' in db.DB.table_names():
+        return
+    db.DB.execute(f"""UPDATE [{histogram}] SET [cumulative_deaths] = c.cumulative,
+                          [cumulative_share] = CAST(c.cumulative AS REAL) / c.total
+                      FROM (SELECT rowid AS id,
+                                SUM([deaths]) OVER (PARTITION BY {keys_sql} ORDER BY [lag]) AS cumulative,
+                                SUM([deaths]) OVER (PARTITION BY {keys_sql}) AS total
+                            FROM [{histogram}]) AS c
+                      WHERE [{histogram}].rowid = c.id""")
+    percentiles_sql = ', '.join(f'MIN(CASE WHEN [cumulative_share] >= {p / 100} THEN [lag] END) AS [lag_p{p}]'
+                                for p in lag_percentiles)
+    db.DB.execute(f"DROP TABLE IF EXISTS [{histogram}_completeness]")
+    db.DB.execute(f"""CREATE TABLE [{histogram}_completeness] AS
+                      SELECT {keys_sql}, SUM([deaths]) AS [deaths], {percentiles_sql}
+                      FROM [{histogram}] GROUP BY {keys_sql}""")
+    tables_written.update([histogram, f'{histogram}_completeness'])
+
+def update():
+    """Update the reporting lag aggregates for the trust, region and age tables."""
+    # Earlier versions noted the dailies they'd added by their publication date
+    db.DB.execute("DROP TABLE IF EXISTS nhs_lag_published")
+    db.DB.execute("""CREATE TABLE IF NOT EXISTS nhs_lag_sources (kind TEXT, reference TEXT, rowids TEXT,
+                     PRIMARY KEY (kind, reference))""")
+    for kind in nhs_index_columns:
+        with stage('lag_aggregates', table=f'nhs_lag_{kind}'):
+            update_lag_aggregates(kind)
@@ -0,0 +1,38 @@
+"""Command line interface.
+
+    python -m uk_coronavirus_deaths                          # a full run
+    python -m uk_coronavirus_deaths --sources nhs-dailies phe
+    python -m uk_coronavirus_deaths --stages ingest          # no aggregates, indexes or export
+    python -m uk_coronavirus_deaths --stages index export    # just reindex and re-export the db
+    python -m uk_coronavirus_deaths --staging                # build a copy, then swap it in
+
+Each source is committed as soon as it has been ingested, and the run metrics are saved, whichever
+stages are run. If a source can't be ingested the rest are still loaded, and the command fails
+at the end.
+"""
+import json
+import argparse
+
+def main(argv=None):
+    """Run the pipeline from the command line."""
+    # Importing the pipeline doesn't import any of the sources, so --help stays quick
+    from . import pipeline
+    parser = argparse.ArgumentParser(prog='python -m uk_coronavirus_deaths',
+                                     description='Grab the UK coronavirus deaths data into a SQLite db.')
+    parser.add_argument('--db', help="the db to update (default: $NHS_DB, or nhs_dailies.db)")
+    parser.add_argument('--sources', nargs='+', choices=list(pipeline.SOURCES),
+                        default=list(pipeline.SOURCES), help="the sources to ingest (default: all)")
+    parser.add_argument('--stages', nargs='+', choices=pipeline.STAGES, default=pipeline.STAGES,
+                        help="the stages to run (default: all)")
+    parser.add_argument('--offline', action='store_true',
+                        help="serve everything from the HTTP cache (as HTTP_CACHE_OFFLINE=1)")
+    parser.add_argument('--staging', action='store_true', default=None,
+                        help="build the db in a staging copy, and publish it over the db once it's "
+                             "done (as NHS_PUBLISH_STAGING=1)")
+    args = parser.parse_args(argv)
+    if args.offline:
+        from . import http_cache
+        http_cache.HTTP_CACHE_OFFLINE = True
+    summary = pipeline.run(args.sources, args.stages, args.db, args.staging)
+    if summary:
+        print(json.dumps(summary['stages'], indent=2))
@@ -0,0 +1,37 @@
+"""Dates.
+
+Dates given as text (such as the *Published* date of the NHS sheets, which is repeated on every
+row once the data is melted) are parsed via `normalise_dates()`. This parses each distinct value
+once, and maps the parsed dates back onto the column. Parsed values are cached, trying the
+formats we expect before falling back to `dateparser`, which can cope with pretty much anything
+but is slow.
+"""
+import datetime
+import functools
+
+import pandas as pd
+
+date_formats = ['%d %B %Y', '%d %b %Y', '%d-%b-%y', '%d-%b-%Y', '%Y-%m-%d', '%d/%m/%Y',
+                '%A %d %B %Y', '%B %d %Y']
+
+@functools.lru_cache(maxsize=None)
+def parse_date(text):
+    """Parse a date string."""
+    text = ' '.join(text.split())
+    for fmt in date_formats:
+        try:
+            return datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    # dateparser is slow to import, so only load it if we need it
+    import dateparser
+    return dateparser.parse(text)
+
+def normalise_dates(series):
+    """Parse a column of date strings, parsing each distinct value once."""
+    if series.dtype != object:
+        return series
+    codes, uniques = pd.factorize(series)
+    parsed = pd.to_datetime([parse_date(v) if isinstance(v, str) else v for v in uniques])
+    return pd.Series(parsed.take(codes, allow_fill=True, fill_value=pd.NaT),
+                     index=series.index, name=series.name)
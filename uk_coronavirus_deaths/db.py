@@ -0,0 +1,355 @@
+"""The database.
+
+The db is opened with `connect()`, which sets `DB` for the rest of the package. The `processed`
+table is a ledger of every source file we have ingested (see `sources`).
+
+All the tables are written through `write_table()`. The column types of the tables we know about
+are declared up front in `table_schemas`; any other columns (for example, the columns of the ONS
+and PHE data, which are taken from the source files) have their type inferred from the dataframe
+when the table is created. Rows are added with `executemany`.
+
+The ledger notes the rows each source wrote by their rowids, so that they can be removed if the
+source is updated. VACUUM may renumber the rowids of a table unless it has an explicit INTEGER
+PRIMARY KEY, so every table we create has one, called `rowid` (tables in dbs built before that
+are given one by `connect()`, keeping their rowids).
+
+The PHE and ONS registration tables hold the latest release of their source. Rather than
+rewriting them from scratch each time, new releases are upserted, keyed on the natural keys in
+`upsert_keys` (which don't include the release date, so that each release lines up with the
+last): the release is written to a staging table, and only the rows that are new, or whose
+values have changed, are written to the table. Rows that have been withdrawn from the latest
+release are deleted (`pruned_tables`) in the same transaction. (Set `NHS_DELTA_UPSERT=0` to
+replace the tables each time instead.)
+
+The ONS weekly deaths and NHS totals tables are appended to, so they have unique keys too
+(`unique_keys`): a row for an observation that's already in the table updates it rather than
+being added again, so the tables never hold duplicates if the database is kept between runs.
+
+A run is loaded with the database set up for fast loading (write-ahead log, a big page cache,
+and only syncing to disk when the log is checkpointed). The load is committed a source at a
+time (a file at a time, for the sources with more than one): everything a file writes, along
+with its ledger entry, is committed together at a `checkpoint()`, and if ingesting it fails,
+just that file is rolled back (see `checkpointed()`). So a run that dies part way through
+leaves the database as it was after the last file it finished, and the next run picks up from
+there. At the end of the run the database is switched back to a normal, fully synced rollback
+journal for publishing.
+"""
+import os
+import json
+import datetime
+import sqlite3
+import contextlib
+
+import pandas as pd
+import sqlite_utils
+
+from .metrics import stage
+
+DB_PATH = os.environ.get('NHS_DB', 'nhs_dailies.db')
+
+DB = None
+
+def drop_untracked():
+    """Drop everything in the db, including the ledger (for a db built without a usable ledger)."""
+    for view in DB.view_names():
+        DB.execute(f"DROP VIEW [{view}]")
+    # Drop the full text search tables first, which takes their shadow tables with them
+    virtual = {name for name, in DB.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                                            "AND sql LIKE 'CREATE VIRTUAL TABLE%'")}
+    for table in sorted(virtual) + sorted(set(DB.table_names()) - virtual):
+        if not table.startswith('sqlite_'):
+            DB.execute(f"DROP TABLE IF EXISTS [{table}]")
+    DB.conn.commit()
+
+def connect(path=None):
+    """Open the db, creating the ledger if need be."""
+    global DB
+    DB = sqlite_utils.Database(path or DB_PATH)
+    processed = DB['processed']
+    # Early versions of the ledger only recorded the link text, which isn't enough to spot updated
+    # files, or which rows came from them; so the tables it was kept for are dropped along with it,
+    # and rebuilt from scratch (otherwise every source would be ingested over them a second time)
+    if processed.exists() and 'sha256' not in processed.columns_dict:
+        drop_untracked()
+    if not processed.exists():
+        processed.create({'reference': str, 'link_text': str, 'url': str,
+                          'sha256': str, 'etag': str, 'last_modified': str,
+                          'tables': str, 'processed_at': str},
+                         pk='reference')
+    ledger_tables = {table for tables, in DB.execute("SELECT tables FROM processed WHERE tables IS NOT NULL")
+                     for table in json.loads(tables)}
+    for table in sorted(ledger_tables):
+        if DB[table].exists():
+            keyed_rowids(table)
+    print("already processed", DB['processed'].count)
+    return DB
+
+nhs_index_columns = {'trust': {'NHS England Region': 'TEXT', 'Code': 'TEXT', 'Name': 'TEXT'},
+                     'age': {'Age group': 'TEXT'},
+                     'region': {'NHS England Region': 'TEXT'}}
+
+table_schemas = {
+    'ons_deaths': {'Age': 'TEXT', 'Date': 'TIMESTAMP', 'value': 'INTEGER',
+                   'measure': 'TEXT', 'Group': 'TEXT'},
+    'ons_deaths_reg': {'Registered up to': 'TIMESTAMP'},
+    'ons_deaths_reg_occ': {'Occurred up to': 'TIMESTAMP', 'Registered up to': 'TIMESTAMP'},
+    'phe_cases': {'Area name': 'TEXT', 'Area code': 'TEXT', 'Area type': 'TEXT',
+                  'Specimen date': 'TIMESTAMP'},
+    'phe_deaths': {'Area name': 'TEXT', 'Area code': 'TEXT', 'Area type': 'TEXT',
+                   'Specimen date': 'TIMESTAMP', 'Reporting date': 'TIMESTAMP'},
+}
+for prefix in ['nhs_dailies', 'nhs_totals', 'nhs_weekly_totals']:
+    for table, index_columns in nhs_index_columns.items():
+        table_schemas[f'{prefix}_{table}'] = {**index_columns, 'Published': 'TIMESTAMP',
+                                              'Date': 'TIMESTAMP', 'value': 'INTEGER',
+                                              'lag': 'INTEGER'}
+        summary = {**index_columns, 'Published': 'TIMESTAMP'}
+        if prefix != 'nhs_dailies':
+            summary['Up to 01-Mar-20'] = 'INTEGER'
+        table_schemas[f'{prefix}_{table}_summary'] = {**summary, 'Awaiting verification': 'INTEGER',
+                                                      'Total': 'INTEGER'}
+
+DELTA_UPSERT = os.environ.get('NHS_DELTA_UPSERT', '1') == '1'
+
+upsert_keys = {
+    'phe_cases': ['Area code', 'Area type', 'Specimen date'],
+    'phe_deaths': ['Area code', 'Area type', 'Reporting date'],
+    'ons_deaths_reg': ['Area code', 'Cause of death', 'Week number', 'Place of death'],
+    'ons_deaths_reg_occ': ['Area code', 'Cause of death', 'Week number', 'Place of death'],
+}
+
+# Tables holding just the latest release, so rows that aren't in it are deleted when it's merged
+pruned_tables = {'phe_cases', 'phe_deaths', 'ons_deaths_reg', 'ons_deaths_reg_occ'}
+
+for table in upsert_keys:
+    table_schemas[f'{table}_staging'] = table_schemas.get(table, {})
+
+unique_keys = {'ons_deaths': ['measure', 'Group', 'Age', 'Date']}
+for prefix in ['nhs_totals', 'nhs_weekly_totals']:
+    for table, index_columns in nhs_index_columns.items():
+        key = ['Code'] if table == 'trust' else list(index_columns)
+        unique_keys[f'{prefix}_{table}'] = key + ['Published', 'Date']
+        unique_keys[f'{prefix}_{table}_summary'] = key + ['Published']
+
+def sql_type(series):
+    """Infer the SQLite column type for a column we haven't declared a type for."""
+    inferred = pd.api.types.infer_dtype(series, skipna=True)
+    if inferred in ('integer', 'boolean'):
+        return 'INTEGER'
+    elif inferred in ('floating', 'mixed-integer-float', 'decimal'):
+        return 'REAL'
+    elif inferred in ('datetime64', 'datetime', 'date'):
+        return 'TIMESTAMP'
+    return 'TEXT'
+
+def sql_values(series):
+    """Convert a column into values we can pass to sqlite3."""
+    if series.dtype.kind == 'M':
+        series = series.dt.strftime('%Y-%m-%d %H:%M:%S')
+    elif series.dtype == object:
+        series = series.map(lambda v: v.isoformat(' ') if isinstance(v, datetime.datetime) else v)
+    return series.astype(object).where(series.notna(), None)
+
+def max_rowid(table):
+    """Get the largest rowid in a table (0 if the table doesn't exist)."""
+    if not DB[table].exists():
+        return 0
+    return DB.execute(f"SELECT COALESCE(MAX(rowid), 0) FROM [{table}]").fetchone()[0]
+
+def prepare_table(df, table, if_exists='append'):
+    """Make sure a table exists with columns for everything in the dataframe."""
+    if if_exists == 'replace':
+        DB.execute(f"DROP TABLE IF EXISTS [{table}]")
+    declared = table_schemas.get(table, {})
+    columns = {str(c): declared.get(str(c)) or sql_type(df[c]) for c in df.columns}
+    if not DB[table].exists():
+        columns_sql = ', '.join(f'[{c}] {t}' for c, t in columns.items())
+        DB.execute(f"CREATE TABLE [{table}] ([rowid] INTEGER PRIMARY KEY, {columns_sql})")
+        return
+    existing = DB[table].columns_dict
+    for c, t in columns.items():
+        if c not in existing:
+            DB.execute(f"ALTER TABLE [{table}] ADD COLUMN [{c}] {t}")
+
+def keyed_rowids(table):
+    """Give a table an explicit `rowid` INTEGER PRIMARY KEY (keeping its rowids), if it hasn't one."""
+    columns = DB[table].columns
+    if any(c.name == 'rowid' for c in columns):
+        return
+    schema = [sql for sql, in DB.execute("SELECT sql FROM sqlite_master WHERE tbl_name = ? "
+                                         "AND type IN ('index', 'trigger') AND sql IS NOT NULL", [table])]
+    columns_sql = ', '.join(f'[{c.name}] {c.type}' for c in columns)
+    names = ', '.join(f'[{c.name}]' for c in columns)
+    with DB.conn:
+        DB.execute(f"DROP TABLE IF EXISTS [{table}_rekeyed]")
+        DB.execute(f"CREATE TABLE [{table}_rekeyed] ([rowid] INTEGER PRIMARY KEY, {columns_sql})")
+        DB.execute(f"INSERT INTO [{table}_rekeyed] ([rowid], {names}) SELECT rowid, {names} FROM [{table}]")
+        DB.execute(f"DROP TABLE [{table}]")
+        # Leave the views on the table (the normalised storage views) alone while it's missing
+        DB.execute("PRAGMA legacy_alter_table=ON")
+        DB.execute(f"ALTER TABLE [{table}_rekeyed] RENAME TO [{table}]")
+        DB.execute("PRAGMA legacy_alter_table=OFF")
+        for sql in schema:
+            DB.execute(sql)
+
+def upsert_sql(table, columns, keys):
+    """SQL for updating the rows whose keys are already in a table (where their values have changed)."""
+    keys_sql = ', '.join(f'[{c}]' for c in keys)
+    values = [c for c in columns if c not in keys]
+    if not values:
+        return f"ON CONFLICT ({keys_sql}) DO NOTHING"
+    updates = ', '.join(f'[{c}] = excluded.[{c}]' for c in values)
+    changed = ' OR '.join(f'[{table}].[{c}] IS NOT excluded.[{c}]' for c in values)
+    return f"ON CONFLICT ({keys_sql}) DO UPDATE SET {updates} WHERE {changed}"
+
+def write_table(df, table, produced, if_exists='append'):
+    """Write a dataframe to the db, noting the range of rowids it was written to.
+
+    If the table has `unique_keys`, rows whose keys are already in the table update those rows
+    rather than adding duplicates."""
+    from . import normalised
+    if normalised.NORMALISED_STORAGE and table in normalised.fact_tables:
+        return normalised.write_facts(df, table, produced)
+    with stage('write', table=table) as metric:
+        metric['rows'] = len(df)
+        prepare_table(df, table, if_exists)
+        start = max_rowid(table)
+        columns = ', '.join(f'[{c}]' for c in df.columns)
+        params = ', '.join('?' for _ in df.columns)
+        insert = f"INSERT INTO [{table}] ({columns}) VALUES ({params})"
+        keys = unique_keys.get(table)
+        if keys and all(c in df.columns for c in keys):
+            keyed_table(table, keys, dedupe=True)
+            insert = f"{insert} {upsert_sql(table, [str(c) for c in df.columns], keys)}"
+        rows = zip(*(sql_values(df[c]) for c in df.columns))
+        DB.conn.executemany(insert, rows)
+        tables_written.add(table)
+        end = max_rowid(table)
+    if end > start:
+        produced.setdefault(table, []).append([start + 1, end])
+
+tables_written = set()
+
+def write_batch(df, table, sizes, produced):
+    """Write the rows from several sources to a table in one go.
+
+    `sizes` is the number of rows from each source, in order, and `produced` the dicts to note
+    each source's rowids in. The table shouldn't have `unique_keys`, so that every row is added."""
+    written = {}
+    write_table(df, table, written)
+    for written_table, ranges in written.items():
+        start = ranges[0][0]
+        for size, _produced in zip(sizes, produced):
+            if size:
+                _produced.setdefault(written_table, []).append([start, start + size - 1])
+            start += size
+
+def keyed_table(table, keys, dedupe=False):
+    """Make sure a table has a unique index on its keys, returning False if it can't have one.
+
+    With dedupe, any duplicate rows already in the table (keeping the latest) are removed
+    so that it can have one."""
+    columns_sql = ', '.join(f'[{c}]' for c in keys)
+    # The keys may have changed since the index was made
+    indexed = [name for _, _, name in DB.execute(f"PRAGMA index_info([uq_{table}])")]
+    if indexed and indexed != list(keys):
+        DB.execute(f"DROP INDEX [uq_{table}]")
+    try:
+        DB.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS [uq_{table}] ON [{table}] ({columns_sql})")
+        return True
+    except sqlite3.IntegrityError:
+        if not dedupe:
+            return False
+    DB.execute(f"""DELETE FROM [{table}] WHERE rowid NOT IN
+                   (SELECT MAX(rowid) FROM [{table}] GROUP BY {columns_sql})""")
+    DB.execute(f"CREATE UNIQUE INDEX [uq_{table}] ON [{table}] ({columns_sql})")
+    return True
+
+def merge_staged(staging, table, keys, produced):
+    """Merge a staging table into a table, keyed on the table's natural keys.
+
+    Only new rows, and rows whose values have changed, are written; and for `pruned_tables`,
+    rows whose keys aren't in the staging table are deleted. If there's no table yet,
+    or it can't be keyed (it has duplicate keys, or the staged data doesn't have the key
+    columns), the staging table replaces it."""
+    staged = {c: t for c, t in DB[staging].columns_dict.items() if c != 'rowid'}
+    start = max_rowid(table)
+    if (table not in DB.table_names() or not all(c in staged for c in keys)
+            or not keyed_table(table, keys)):
+        DB.execute(f"DROP TABLE IF EXISTS [{table}]")
+        DB.execute(f"ALTER TABLE [{staging}] RENAME TO [{table}]")
+        if all(c in staged for c in keys):
+            keyed_table(table, keys)
+        tables_written.add(table)
+        end = max_rowid(table)
+        if end:
+            produced.setdefault(table, []).append([1, end])
+        return
+    existing = DB[table].columns_dict
+    for column in DB[staging].columns:
+        if column.name not in existing and column.name != 'rowid':
+            DB.execute(f"ALTER TABLE [{table}] ADD COLUMN [{column.name}] {column.type}")
+    columns = ', '.join(f'[{c}]' for c in staged)
+    before = DB.conn.total_changes
+    DB.execute(f"""INSERT INTO [{table}] ({columns}) SELECT {columns} FROM [{staging}] WHERE true
+                   {upsert_sql(table, list(staged), keys)}""")
+    print(f"{table}: {DB.conn.total_changes - before} rows added or changed")
+    if table in pruned_tables:
+        keys_sql = ', '.join(f'[{c}]' for c in keys)
+        DB.execute(f"CREATE INDEX [ix_{staging}] ON [{staging}] ({keys_sql})")
+        matched = ' AND '.join(f's.[{c}] IS [{table}].[{c}]' for c in keys)
+        before = DB.conn.total_changes
+        DB.execute(f"DELETE FROM [{table}] WHERE NOT EXISTS (SELECT 1 FROM [{staging}] s WHERE {matched})")
+        print(f"{table}: {DB.conn.total_changes - before} withdrawn rows deleted")
+    DB.execute(f"DROP TABLE [{staging}]")
+    tables_written.add(table)
+    end = max_rowid(table)
+    if end > start:
+        produced.setdefault(table, []).append([start + 1, end])
+
+def upsert_table(df, table, produced):
+    """Write the latest release of a source to its table, upserting it if we can."""
+    if not DELTA_UPSERT:
+        return write_table(df, table, produced, if_exists='replace')
+    staging = f'{table}_staging'
+    write_table(df, staging, {}, if_exists='replace')
+    merge_staged(staging, table, upsert_keys[table], produced)
+
+def begin_bulk_load():
+    """Set the database up for a fast bulk load, and start the transaction."""
+    DB.execute("PRAGMA journal_mode=WAL")
+    # Commits only need to survive the process dying; the log is synced when it's checkpointed
+    DB.execute("PRAGMA synchronous=NORMAL")
+    DB.execute("PRAGMA cache_size=-262144")
+    DB.execute("PRAGMA temp_store=MEMORY")
+    DB.execute("BEGIN")
+
+def checkpoint():
+    """Commit everything written since the last checkpoint, and start a new transaction."""
+    DB.conn.commit()
+    DB.execute("BEGIN")
+
+def rollback():
+    """Throw away everything written since the last checkpoint, and start a new transaction."""
+    from . import normalised
+    DB.conn.rollback()
+    # Any dimension members added since the checkpoint have gone too
+    normalised._dimension_cache.clear()
+    DB.execute("BEGIN")
+
+@contextlib.contextmanager
+def checkpointed():
+    """Commit everything written in the block together, or if it fails, none of it."""
+    try:
+        yield
+    except BaseException:
+        rollback()
+        raise
+    checkpoint()
+
+def end_bulk_load():
+    """Commit the bulk load, and put the database back into a safe state for publishing."""
+    DB.conn.commit()
+    DB.execute("PRAGMA synchronous=FULL")
+    DB.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    DB.execute("PRAGMA journal_mode=DELETE")
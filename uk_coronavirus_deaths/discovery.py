@@ -0,0 +1,74 @@
+"""Discovering and prefetching sources.
+
+Most of the sources are found via links on a landing page (the NHS reporting page, and the two
+ONS dataset pages). Rather than fetch each landing page in turn, and only start downloading once
+the links have been found, the landing pages are all fetched concurrently and each source is
+queued for download as soon as it's found, so the downloads overlap with the rest of the
+discovery. Just the part of each page holding the links is parsed (with a `SoupStrainer`).
+
+The pages are fetched, and the sources downloaded, in worker threads via the HTTP cache's pooled
+session. The downloads are kept (see `sources.prefetch_source()`) and picked up when each
+source is ingested. The ledger is read up front, so discovery never touches the db.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .sources import DOWNLOAD_WORKERS, ledger_entries, prefetch_source, scrape
+
+def _in_thread(func, *args):
+    """Run a function in the event loop's default thread pool (`asyncio.to_thread` needs 3.9)."""
+    return asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+async def _discover_page(page, parse_only, finders, ledger, queue):
+    """Scrape a landing page, and queue the sources found on it."""
+    try:
+        await _in_thread(scrape, page, parse_only)
+    except (requests.RequestException, OSError) as e:
+        # Leave it to the source to try again (and report the error) when it's ingested
+        print(f"Couldn't scrape {page}: {e}")
+        return
+    for find in finders:
+        try:
+            found = list(find(ledger))
+        except Exception as e:
+            # A page that isn't laid out as we expect, say; the source fails when it's ingested
+            print(f"Couldn't find the sources on {page} with {find.__name__}: {e!r}")
+            continue
+        for reference, url, link_text in found:
+            await queue.put((reference, url, link_text, ledger.get(reference)))
+
+async def _download(queue):
+    """Download the sources from the queue."""
+    while True:
+        reference, url, link_text, seen = await queue.get()
+        try:
+            await _in_thread(prefetch_source, reference, url, link_text, seen)
+        finally:
+            queue.task_done()
+
+async def _discover(pages, ledger, workers):
+    queue = asyncio.Queue()
+    downloads = [asyncio.create_task(_download(queue)) for _ in range(workers)]
+    await asyncio.gather(*(_discover_page(page, parse_only, finders, ledger, queue)
+                           for page, (parse_only, finders) in pages.items()))
+    await queue.join()
+    for download in downloads:
+        download.cancel()
+
+def discover(pages, workers=None):
+    """Scrape the landing pages concurrently, and prefetch the sources found on them.
+
+    `pages` maps each landing page to the `SoupStrainer` arguments for its links, and a list of
+    functions that find the sources on it: given the ledger entries (by reference), they return
+    the sources to download as (reference, url, link text)."""
+    run = _discover(pages, ledger_entries(), workers or DOWNLOAD_WORKERS)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(run)
+    # There's already an event loop running in this thread (in a notebook, say), so use another
+    with ThreadPoolExecutor(1) as executor:
+        executor.submit(asyncio.run, run).result()
@@ -0,0 +1,172 @@
+"""A simple on-disk HTTP cache.
+
+Response bodies are stored along with their validators, and repeat requests are made
+conditional (`If-None-Match` / `If-Modified-Since`); if the server replies `304 Not Modified`,
+the body is served from the cache. The cache is bounded in size, and the least recently used
+responses are evicted first.
+
+The cache lives in `HTTP_CACHE_DIR` (`.http_cache` by default). Setting `HTTP_CACHE_OFFLINE=1`
+serves everything from the cache without touching the network, so a run can be replayed against
+a directory of recorded responses.
+
+Requests go through a single pooled session, so connections to a host are kept alive and reused
+by all the threads fetching from it.
+"""
+import os
+import io
+import json
+import hashlib
+import threading
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+HTTP_CACHE_DIR = os.environ.get('HTTP_CACHE_DIR', '.http_cache')
+HTTP_CACHE_MAX_BYTES = int(os.environ.get('HTTP_CACHE_MAX_BYTES', 1024 ** 3))
+HTTP_CACHE_OFFLINE = os.environ.get('HTTP_CACHE_OFFLINE') == '1'
+
+_http_cache_lock = threading.Lock()
+
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+def _http_cache_paths(url):
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    path = os.path.join(HTTP_CACHE_DIR, key)
+    return f'{path}.json', f'{path}.body'
+
+def _http_cache_response(url, meta):
+    """Build a response (without its body) from a cache entry."""
+    r = requests.models.Response()
+    r.status_code = 200
+    r.url = meta['final_url']
+    r.headers = CaseInsensitiveDict(meta['headers'])
+    r.encoding = meta['encoding']
+    return r
+
+def _http_cache_store(url, r, body_tmp_path):
+    """Add a response, whose body has been written to body_tmp_path, to the cache.
+
+    Old entries are evicted if the cache is full."""
+    meta_path, body_path = _http_cache_paths(url)
+    meta = {'url': url, 'final_url': r.url, 'encoding': r.encoding,
+            'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified'),
+            'headers': dict(r.headers)}
+    # Write to temporary files and swap them in, so a reader never sees a partial entry
+    with open(f'{meta_path}.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(body_tmp_path, body_path)
+    os.replace(f'{meta_path}.tmp', meta_path)
+    http_cache_evict()
+
+class _HttpCacheBody(io.RawIOBase):
+    """The body of a response, copied into the cache as it's read.
+
+    The entry is only added to the cache once the body has been read to the end."""
+    def __init__(self, url, r, chunk_size=1024 ** 2):
+        self.url, self.r = url, r
+        self.chunks = r.iter_content(chunk_size)
+        self.chunk, self.pos = memoryview(b''), 0
+        os.makedirs(HTTP_CACHE_DIR, exist_ok=True)
+        self.tmp_path = f'{_http_cache_paths(url)[1]}.{threading.get_ident()}.tmp'
+        self.cache_file = open(self.tmp_path, 'wb')
+
+    def readable(self):
+        return True
+
+    def _next_chunk(self):
+        chunk = next(self.chunks, b'')
+        if chunk:
+            self.cache_file.write(chunk)
+        elif not self.cache_file.closed:
+            self.cache_file.close()
+            _http_cache_store(self.url, self.r, self.tmp_path)
+        self.chunk, self.pos = memoryview(chunk), 0
+        return len(chunk)
+
+    def readinto(self, b):
+        if self.pos == len(self.chunk) and not self._next_chunk():
+            return 0
+        n = min(len(b), len(self.chunk) - self.pos)
+        b[:n] = self.chunk[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def readall(self):
+        parts = [bytes(self.chunk[self.pos:])]
+        while self._next_chunk():
+            parts.append(bytes(self.chunk))
+        return b''.join(parts)
+
+    def close(self):
+        if not self.cache_file.closed:
+            # Not read to the end, so don't cache a partial body
+            self.cache_file.close()
+            os.remove(self.tmp_path)
+        self.r.close()
+        super().close()
+
+def http_cache_evict(max_bytes=None):
+    """Remove least recently used cache entries until the cache fits in max_bytes."""
+    max_bytes = max_bytes or HTTP_CACHE_MAX_BYTES
+    with _http_cache_lock:
+        entries = []
+        for fn in os.listdir(HTTP_CACHE_DIR):
+            if not fn.endswith('.json'):
+                continue
+            meta_path = os.path.join(HTTP_CACHE_DIR, fn)
+            body_path = f'{meta_path[:-len(".json")]}.body'
+            try:
+                size = os.path.getsize(meta_path) + os.path.getsize(body_path)
+                entries.append((os.path.getmtime(meta_path), size, meta_path, body_path))
+            except OSError:
+                continue
+        total = sum(e[1] for e in entries)
+        for _, size, meta_path, body_path in sorted(entries):
+            if total <= max_bytes:
+                break
+            for path in (meta_path, body_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            total -= size
+
+def http_cache_open(url, headers=None):
+    """GET a URL via the on-disk cache, streaming the body.
+
+    Returns the response and a binary file object for its body, or None for the body if the
+    request didn't succeed."""
+    meta_path, body_path = _http_cache_paths(url)
+    meta = None
+    if os.path.exists(meta_path) and os.path.exists(body_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        # Mark the entry as recently used
+        os.utime(meta_path)
+    if HTTP_CACHE_OFFLINE:
+        if meta is None:
+            raise requests.ConnectionError(f"Not in the HTTP cache (offline): {url}")
+        return _http_cache_response(url, meta), open(body_path, 'rb')
+    headers = dict(headers or {})
+    if meta:
+        # If we have the body cached, revalidate it with our own validators
+        headers.pop('If-None-Match', None)
+        headers.pop('If-Modified-Since', None)
+        if meta['etag']:
+            headers['If-None-Match'] = meta['etag']
+        if meta['last_modified']:
+            headers['If-Modified-Since'] = meta['last_modified']
+    r = session.get(url, headers=headers, allow_redirects=True, stream=True)
+    if r.status_code == 304 and meta:
+        r.close()
+        return _http_cache_response(url, meta), open(body_path, 'rb')
+    if r.status_code != 200:
+        return r, None
+    return r, _HttpCacheBody(url, r)
+
+def http_cache_get(url, headers=None):
+    """GET a URL via the on-disk cache."""
+    r, body = http_cache_open(url, headers)
+    if body is not None:
+        with body:
+            r._content = body.read()
+    return r
@@ -0,0 +1,65 @@
+"""Indexes.
+
+The published database is mostly queried via Datasette, filtering by trust, region, area or age
+group and by date, publication date or reporting lag. `index_database()` adds indexes for those
+access patterns, along with full text search over trust and area names so that they can be
+searched for by name. Indexes that already exist are left alone, but the full text indexes are
+rebuilt for any table we've written to during this run. Finally, `ANALYZE` so the query planner
+knows how to use the indexes.
+"""
+from . import db
+from .db import nhs_index_columns, tables_written
+from .normalised import fact_keys, fact_tables
+
+table_indexes = {
+    'ons_deaths': [['measure', 'Group', 'Age', 'Date'], ['Date']],
+    'ons_deaths_reg': [['Area code'], ['Area name'], ['Cause of death']],
+    'ons_deaths_reg_occ': [['Area code'], ['Area name'], ['Cause of death']],
+    'phe_cases': [['Area name', 'Specimen date'], ['Area code', 'Specimen date'], ['Specimen date']],
+    'phe_deaths': [['Area name', 'Specimen date'], ['Area code', 'Specimen date'], ['Specimen date'],
+                   ['Area name', 'Reporting date'], ['Area code', 'Reporting date'], ['Reporting date']],
+}
+for prefix in ['nhs_dailies', 'nhs_totals', 'nhs_weekly_totals']:
+    table_indexes[f'{prefix}_trust'] = [['Name', 'Date'], ['Code', 'Published', 'Date'],
+                                        ['NHS England Region', 'Date']]
+    table_indexes[f'{prefix}_region'] = [['NHS England Region', 'Date']]
+    table_indexes[f'{prefix}_age'] = [['Age group', 'Date']]
+    for table in ['trust', 'region', 'age']:
+        table_indexes[f'{prefix}_{table}'] += [['Published', 'Date'], ['Date'], ['lag']]
+        table_indexes[f'{prefix}_{table}_summary'] = [[next(iter(nhs_index_columns[table]))],
+                                                      ['Published']]
+    table_indexes[f'{prefix}_trust_summary'] += [['Code', 'Published']]
+
+for table, kind in fact_tables.items():
+    days = ['day'] if kind == 'ons' else ['published_day', 'day']
+    table_indexes[f'{table}_facts'] = [fact_keys[kind] + ['day'], days, ['day']]
+table_indexes['dim_trust'] = [['name'], ['code'], ['region_id']]
+for table, columns in nhs_index_columns.items():
+    table_indexes[f'nhs_lag_{table}'] = [['lag']]
+    table_indexes[f'nhs_lag_{table}_completeness'] = [[c] for c in columns]
+
+table_fts = {'dim_trust': ['name'],
+             'phe_cases': ['Area name'], 'phe_deaths': ['Area name'],
+             'ons_deaths_reg': ['Area name'], 'ons_deaths_reg_occ': ['Area name'],
+             'nhs_dailies_trust_summary': ['Name'], 'nhs_totals_trust_summary': ['Name'],
+             'nhs_weekly_totals_trust_summary': ['Name']}
+
+def index_database():
+    """Add the query indexes and full text search, and update the query planner statistics."""
+    table_names = db.DB.table_names()
+    for table, indexes in table_indexes.items():
+        # Views (such as the normalised storage views) can't be indexed
+        if table not in table_names:
+            continue
+        existing = db.DB[table].columns_dict
+        for columns in indexes:
+            if all(c in existing for c in columns):
+                name = 'idx_{}_{}'.format(table, '_'.join(columns)).replace(' ', '_')
+                columns_sql = ', '.join(f'[{c}]' for c in columns)
+                db.DB.execute(f"CREATE INDEX IF NOT EXISTS [{name}] ON [{table}] ({columns_sql})")
+    db.DB.conn.commit()
+    for table, columns in table_fts.items():
+        if db.DB[table].exists() and (table in tables_written or not db.DB[f'{table}_fts'].exists()):
+            db.DB[table].enable_fts(columns, replace=True)
+    db.DB.execute("ANALYZE")
+    db.DB.conn.commit()
@@ -0,0 +1,87 @@
+"""Run metrics.
+
+Each stage of the pipeline (scraping a page, downloading and reading a file, cleaning,
+reshaping, parsing dates and writing to the db) is timed with `stage()`, noting the bytes and
+rows it handled, how much the memory use (RSS) of the process grew over the stage, and the
+process's peak RSS so far. (RSS is for the whole process, so the growth of stages that run at the
+same time in different threads overlaps, and it's only measured on Linux.) At the end of the run the
+metrics are added to the `run_metrics` table, and a summary is written to `RUN_METRICS_JSON`
+(`run_metrics.json` by default).
+"""
+import os
+import sys
+import json
+import time
+import datetime
+import threading
+import resource
+from contextlib import contextmanager
+
+RUN_ID = datetime.datetime.utcnow().isoformat()
+RUN_START = time.perf_counter()
+RUN_METRICS_JSON = os.environ.get('RUN_METRICS_JSON', 'run_metrics.json')
+
+run_metrics = []
+_run_metrics_lock = threading.Lock()
+
+def peak_rss_mb():
+    """Get the peak resident set size of this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, KB elsewhere
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+def rss_mb():
+    """Get the current resident set size of this process, in MB (or None, if it can't be read)."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+
+@contextmanager
+def stage(name, source=None, table=None, metrics=None):
+    """Time a stage of the pipeline.
+
+    Yields the metric record, so that the bytes and rows the stage handled can be filled in.
+    It is added to `metrics` (by default, `run_metrics`) when the stage finishes."""
+    metric = {'run_id': RUN_ID, 'stage': name, 'source': source, 'table': table,
+              'seconds': None, 'bytes': None, 'rows': None, 'rss_growth_mb': None, 'peak_rss_mb': None}
+    start = time.perf_counter()
+    start_rss = rss_mb()
+    try:
+        yield metric
+    finally:
+        metric['seconds'] = time.perf_counter() - start
+        end_rss = rss_mb()
+        if start_rss is not None and end_rss is not None:
+            metric['rss_growth_mb'] = end_rss - start_rss
+        metric['peak_rss_mb'] = peak_rss_mb()
+        with _run_metrics_lock:
+            (run_metrics if metrics is None else metrics).append(metric)
+
+def add_metrics(metrics):
+    """Add metrics recorded elsewhere (for example, in a worker process) to this run's."""
+    with _run_metrics_lock:
+        run_metrics.extend({**metric, 'run_id': RUN_ID} for metric in metrics)
+
+def save_run_metrics(path=None):
+    """Add this run's metrics to the db, and write a summary of them to a JSON file."""
+    import pandas as pd
+    from . import db
+    path = path or RUN_METRICS_JSON
+    db.DB['run_metrics'].insert_all(run_metrics, columns={'run_id': str, 'stage': str, 'source': str,
+                                                          'table': str, 'seconds': float, 'bytes': int,
+                                                          'rows': int, 'rss_growth_mb': float,
+                                                          'peak_rss_mb': float}, alter=True)
+    metrics = pd.DataFrame(run_metrics)
+    totals = metrics.groupby('stage', sort=False).agg(count=('seconds', 'size'), seconds=('seconds', 'sum'),
+                                                      bytes=('bytes', 'sum'), rows=('rows', 'sum'),
+                                                      rss_growth_mb=('rss_growth_mb', 'max'))
+    summary = {'run_id': RUN_ID, 'seconds': time.perf_counter() - RUN_START,
+               'peak_rss_mb': peak_rss_mb(),
+               'stages': json.loads(totals.to_json(orient='index')),
+               'slowest': json.loads(metrics.nlargest(10, 'seconds').to_json(orient='records'))}
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
@@ -0,0 +1,407 @@
+"""NHS England daily announced deaths.
+
+https://www.england.nhs.uk/statistics/statistical-work-areas/covid-19-daily-deaths/
+
+Daily reports are published as Excel spreadsheets linked from the reporting page, along with
+two totals workbooks (all the deaths announced so far, and the weekly tables). The daily
+reports are each published once under their own link, so the link text is used as their ledger
+reference. The totals workbooks are republished under a new link each day, so they are tracked
+in the ledger under a fixed reference and any rows from the previous version are replaced.
+
+There can be hundreds of daily reports, so they are fetched concurrently. Downloads are I/O
+bound and run in a pool of threads; parsing and cleaning the workbooks is CPU bound and runs in
+a pool of processes. Each parse is started as soon as its download arrives, but the results are
+handed back in link order so that the database is always written in the same order. The pool
+sizes can be set via the `NHS_DOWNLOAD_WORKERS` and `NHS_PARSE_WORKERS` environment variables.
+
+Rather than reshape each sheet of each report in turn, the cleaned sheets of each kind (trust,
+age, region) from a batch of reports are stacked and melted into long form together by
+`melt_lag()`, and each table is written in one go. Each batch is committed along with its
+ledger entries, so a run that dies part way through doesn't lose the batches already written.
+"""
+import os
+import traceback
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from parse import parse
+
+from .dates import normalise_dates, parse_date
+from .db import checkpoint, checkpointed, write_batch, write_table
+from .metrics import add_metrics, stage
+from .parse_cache import cached_frames, load_frames, store_frames
+from .sheets import anchor_index, read_sheets, sheet_dtypes, typed_sheet
+from .sources import (DOWNLOAD_WORKERS, download_source, fetch_source, forget_source,
+                      processed_references, record_source, scrape)
+
+LANDING_PAGE = 'https://www.england.nhs.uk/statistics/statistical-work-areas/covid-19-daily-deaths/'
+# The links we want are all in the body of the page
+LANDING_PAGE_LINKS = {'name': 'article', 'attrs': {'class': 'rich-text'}}
+
+TOTALS_REFERENCES = {'NHS total announced deaths': 'nhs_totals',
+                     'NHS total announced deaths weekly tables': 'nhs_weekly_totals'}
+
+# Sheet names keep changing, so we normalise them via a lookup of aliases. Some of the `ignore`
+# sheets should be treated as "ignore for now" - there is data we can scrape but it may not be
+# in a form currently handled.
+sheet_aliases = {
+    'COVID19 daily deaths by age': 'deaths by age',
+    'COVID19 daily deaths by region': 'deaths by region',
+    'COVID19 daily deaths by trust': 'deaths by trust',
+    # TO DO - could the totals as well as daily sheet move to this convention?
+    'Tab1 Deaths by region': 'deaths by region', 
+    'Tab2 Deaths - no pos test': 'ignore', 
+    'Tab3 Deaths by age': 'deaths by age',
+    'Tab4 Deaths by trust': 'deaths by trust',
+    'Contents': 'ignore',
+    'Fig1 Daily deaths': 'ignore',
+    'COVID19 daily deaths chart': 'ignore',
+    'Deaths by region- no pos test ':  'ignore',
+    'Deaths by region-negative test ': 'ignore',
+    'Deaths by region - no pos test ':  'ignore',
+    'COVID19 total deaths chart': 'ignore',
+    'COVID19 total deaths by trust': 'deaths by trust',
+    'COVID19 total deaths by region': 'deaths by region',
+    'COVID19 total deaths by age': 'deaths by age',
+    'COVID19 all deaths by ethnicity': 'deaths by ethnicity',
+    'COVID19 all deaths by gender': 'deaths by gender',
+    'COVID19 all deaths by condition': 'ignore',
+    'Tab1 Deaths by ethnicity': 'deaths by ethnicity',
+    'Tab2 Deaths by gender': 'deaths by gender', 
+    'Tab3 Deaths by condition': 'ignore',
+    'Tab4 Deaths by cond (detail)': 'deaths by condition'
+}
+
+# Only the sheets with an alias that isn't `ignore` are parsed
+wanted_sheets = [name for name, alias in sheet_aliases.items() if alias != 'ignore']
+
+# The cleaner tries to clean things automatically - we drop the national aggregate values.
+# Should work for:
+#COVID19 total deaths by trust
+#COVID19 total deaths by region
+#COVID19 total deaths by age
+#COVID19 all deaths by ethnicity
+#COVID19 all deaths by gender
+
+# Currently excludes:
+#COVID19 total deaths chart
+#Deaths by region - no pos test
+#COVID19 all deaths by condition
+
+header_cribs = ['Age group', 'Ethnic group', 'Date introduced', 'NHS England Region']
+cleaner_anchors = ['Published:'] + header_cribs + ['Notes:']
+
+def cleaner(sheets):
+    print('Entering cleaner...')
+    for sheet in sheets:
+        print(f"Trying sheet...{sheet}")
+        #if 'chart' in sheet or 'no pos' in sheet or 'condition' in sheet:
+        #    continue
+        if sheet not in sheet_aliases or sheet_aliases[sheet]=='ignore':
+            continue
+        anchors = anchor_index(sheets[sheet], cleaner_anchors)
+        rows, cols = anchors['Published:']
+        published_date = sheets[sheet].iat[rows[0], cols[0]+1]
+
+        if 'age' in sheet or 'gender' in sheet_aliases[sheet]:
+            rows, cols = anchors['Age group']
+            #print((rows, cols))
+            _ix= rows[0]
+        elif 'ethnicity' in sheet_aliases[sheet]:
+            rows, cols = anchors['Ethnic group']
+            #print((rows, cols))
+            _ix= rows[0]
+        elif 'condition' in sheet_aliases[sheet]:
+            rows, cols = anchors['Date introduced']
+            _ix= rows[0]
+        else:
+            rows, cols = anchors['NHS England Region']
+            #print((sheet, rows, cols))
+            _ix= rows[0] #ix[sheet][0]
+
+        # Drop lines after Notes
+        rows, cols = anchors['Notes:']
+        rows = rows[rows > _ix]
+        _end = rows[0] if len(rows) else None
+
+        colnames = sheets[sheet].iloc[_ix]
+        sheets[sheet] = sheets[sheet].iloc[_ix+3:_end]
+        sheets[sheet].columns = colnames
+        sheets[sheet].dropna(axis=1, how='all', inplace=True)
+        sheets[sheet].dropna(axis=0, how='all', inplace=True)
+        sheets[sheet] = sheets[sheet].loc[:, sheets[sheet].columns.notnull()]
+        #display(f'Checking: {sheet}')
+        sheets[sheet]['Published'] = published_date
+        sheets[sheet].reset_index(inplace=True, drop=True)
+        sheets[sheet] = typed_sheet(sheets[sheet], sheet_dtypes[sheet_aliases[sheet]])
+         #sheets[sheet].dropna(axis=0, subset=[sheets[sheet].columns[0]], inplace=True)
+
+    return sheets
+
+def nhs_links():
+    """Scrape the links to the daily reports and the totals workbooks from the reporting page.
+
+    Returns a dict of the daily report links, keyed by their link text, and the
+    (link, link text) of the totals and weekly totals workbooks."""
+    dailies, totals, weekly_totals = {}, (None, None), (None, None)
+    for link in scrape(LANDING_PAGE, LANDING_PAGE_LINKS).find("article", {"class": "rich-text"}).find_all('a'):
+        if link.text.startswith('COVID 19 daily announced deaths'):
+            if link.text not in dailies:
+                dailies[link.text] = link.get('href')
+        elif link.text.startswith('COVID 19 total announced deaths') and link.text.endswith('weekly tables'):
+            weekly_totals = (link.get('href'), link.text)
+        elif link.text.startswith('COVID 19 total announced deaths'):
+            totals = (link.get('href'), link.text)
+    return dailies, totals, weekly_totals
+
+
+PARSE_WORKERS = int(os.environ.get('NHS_PARSE_WORKERS', os.cpu_count() or 1))
+
+# The number of daily reports written (and committed) together
+DAILIES_BATCH = int(os.environ.get('NHS_DAILIES_BATCH', 50))
+
+# Bump this whenever the reading, cleaning or reshaping of the workbooks changes (see `parse_cache`)
+PARSER_VERSION = 3
+
+def parse_daily(content, reference=None):
+    """Read and clean a daily workbook (runs in a worker process).
+
+    Returns the cleaned sheets as a list of (table, dataframe), along with the worker's stage
+    metrics."""
+    metrics = []
+    with stage('read_excel', reference, metrics=metrics) as metric:
+        metric['bytes'] = len(content)
+        _, sheets = read_sheets(content, wanted_sheets, stop_at='Notes:', stop_after=header_cribs)
+        metric['rows'] = sum(len(sheet) for sheet in sheets.values())
+    with stage('cleaner', reference, metrics=metrics) as metric:
+        sheets = cleaner(sheets)
+        metric['rows'] = sum(len(sheet) for sheet in sheets.values())
+    return [(f'nhs_dailies_{kind}', sheets[sheet]) for sheet, kind in sheet_kinds(sheets)], metrics
+
+def parse_pool(workers):
+    """Get an executor for parsing workbooks."""
+    if workers <= 1:
+        return ThreadPoolExecutor(1)
+    # Forking is quickest where we can, but the workers only need to import this module
+    fork = 'fork' in multiprocessing.get_all_start_methods()
+    pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork') if fork else None)
+    # Start the workers now, before any download threads are running
+    pool.submit(int).result()
+    return pool
+
+def fetch_dailies(links, download_workers=None, parse_workers=None):
+    """Download and parse daily workbooks concurrently.
+
+    Workbooks we've parsed before are loaded from the parse cache instead. Yields
+    (link, source, sheets) in link order, with the cleaned sheets as a list of (table, dataframe);
+    sheets is None if the workbook couldn't be downloaded or parsed."""
+    download_workers = download_workers or DOWNLOAD_WORKERS
+    parse_workers = parse_workers or PARSE_WORKERS
+    with parse_pool(parse_workers) as parsers, ThreadPoolExecutor(download_workers) as downloads:
+        downloaded = {downloads.submit(download_source, link, links[link], link): link
+                      for link in links}
+        parsing = {}
+        for future in as_completed(downloaded):
+            link = downloaded[future]
+            try:
+                src = future.result()
+                frames = load_frames(src.sha256, 'nhs_dailies', PARSER_VERSION)
+                parsed = None if frames is not None else parsers.submit(parse_daily, src.content, link)
+                parsing[link] = (src, frames, parsed)
+            except Exception as e:
+                print(f"Couldn't download {link}: {e}")
+                parsing[link] = (None, None, None)
+        for link in links:
+            src, frames, parsed = parsing[link]
+            if parsed is None:
+                yield link, src, frames
+                continue
+            try:
+                frames, metrics = parsed.result()
+                add_metrics(metrics)
+                store_frames(src.sha256, 'nhs_dailies', PARSER_VERSION, frames)
+            except Exception as e:
+                print(f"Couldn't parse {link}: {e}")
+                frames = None
+            yield link, src, frames
+
+def getLinkDate(link):
+    """Get date from link text."""
+    _date = parse('COVID 19 daily announced deaths {date}', link)['date']
+    return parse_date(_date)
+
+def read_totals(src):
+    """Read and clean a totals workbook."""
+    with stage('read_excel', src.reference) as metric:
+        metric['bytes'] = len(src.content)
+        sheets = read_sheets(src.content, wanted_sheets, stop_at='Notes:', stop_after=header_cribs)[1]
+        metric['rows'] = sum(len(sheet) for sheet in sheets.values())
+    with stage('cleaner', src.reference) as metric:
+        sheets = cleaner(sheets)
+        metric['rows'] = sum(len(sheet) for sheet in sheets.values())
+    return sheets
+
+# The index columns of the trust, age and region sheets
+idx = {'trust': ['NHS England Region','Code','Name', 'Published'],
+       'age': ['Age group', 'Published'],
+       'region': ['NHS England Region', 'Published'] }
+
+NS_PER_DAY = 24 * 60 * 60 * 10 ** 9
+
+def sheet_kinds(sheets):
+    """The sheets we use from a workbook, along with their kind (`trust`, `age`, `ethnicity`...)."""
+    for sheet in sheets.keys():
+        if sheet not in sheet_aliases or sheet_aliases[sheet]=='ignore':
+            continue
+        yield sheet, parse('deaths by {table}', sheet_aliases[sheet])['table']
+
+def melt_lag(wides, idx_cols, drop=(), table=None):
+    """Melt a batch of sheets of one kind into long form in one go, and add the reporting lag.
+
+    The sheets are stacked and melted together, and the rows for each come out in the same order
+    as melting it on its own would give. Each distinct date (column header, or published date) is
+    parsed once for the whole batch, and the lag is worked out in whole days with integer
+    arithmetic. Returns the long frame, and the number of rows that came from each sheet."""
+    with stage('melt', table=table) as metric:
+        ids, positions, dates, values, sizes = [], [], [], [], []
+        offset = 0
+        for wide in wides:
+            melted = ~wide.columns.isin(list(idx_cols) + list(drop))
+            n, k = len(wide), int(melted.sum())
+            ids.append(wide[idx_cols])
+            # Column by column, as melt does
+            positions.append(np.tile(np.arange(offset, offset + n), k))
+            dates.append(np.repeat(wide.columns[melted].to_numpy(dtype=object), n))
+            block = wide.loc[:, melted]
+            if all(dtype == 'Int64' for dtype in block.dtypes):
+                values.append(pd.arrays.IntegerArray(block.to_numpy('int64', na_value=0).ravel('F'),
+                                                     block.isna().to_numpy().ravel('F')))
+            else:
+                values.append(block.to_numpy(dtype=object).ravel('F'))
+            sizes.append(n * k)
+            offset += n
+        ids = pd.concat(ids, ignore_index=True)
+        long = ids.take(np.concatenate(positions)).reset_index(drop=True)
+        long['Date'] = np.concatenate(dates)
+        long['value'] = pd.concat([pd.Series(v) for v in values], ignore_index=True)
+        metric['rows'] = len(long)
+    with stage('dates', table=table) as metric:
+        codes, headers = pd.factorize(long['Date'])
+        long['Date'] = pd.to_datetime(headers).take(codes, allow_fill=True, fill_value=pd.NaT)
+        published = normalise_dates(ids['Published'])
+        long['Published'] = published.take(np.concatenate(positions)).to_numpy()
+        lag = (long['Published'].to_numpy().view('i8') - long['Date'].to_numpy().view('i8')) // NS_PER_DAY
+        long['lag'] = pd.arrays.IntegerArray(lag, long['Published'].isna().to_numpy() | long['Date'].isna().to_numpy())
+        metric['rows'] = len(long)
+    return long, sizes
+
+def daily_targets(ledger=None):
+    """The daily reports we haven't already processed, as (reference, url, link text).
+
+    The ledger entries (by reference) are read from the db if they aren't given."""
+    already_processed = set(processed_references() if ledger is None else ledger)
+    return [(l, link, l) for l, link in nhs_links()[0].items() if l not in already_processed]
+
+def write_dailies(dailies):
+    """Write a batch of daily reports, given as (source, cleaned sheets), and add them to the ledger.
+
+    The sheets of each kind from all the reports are reshaped together, and written in one go."""
+    batches = {}
+    for i, (src, sheets) in enumerate(dailies):
+        for table, wide in sheets:
+            batches.setdefault(table, []).append((i, wide))
+    produced = [{} for _ in dailies]
+    for table, batch in batches.items():
+        owners = [produced[i] for i, _ in batch]
+        wides = [wide for _, wide in batch]
+        idx_cols = idx[table[len('nhs_dailies_'):]]
+        df_long, sizes = melt_lag(wides, idx_cols, ['Awaiting verification', 'Total'], table)
+        write_batch(df_long, table, sizes, owners)
+
+        cols = idx_cols + ['Awaiting verification', 'Total']
+        write_batch(pd.concat([wide[cols] for wide in wides], ignore_index=True),
+                    f'{table}_summary', [len(wide) for wide in wides], owners)
+    for (src, _), _produced in zip(dailies, produced):
+        record_source(src, _produced)
+
+def update_dailies():
+    """Ingest any daily reports we haven't already processed.
+
+    The reports are written and committed in batches of `NHS_DAILIES_BATCH`, so if the run dies
+    part way through, the next one picks up from the last batch that was committed."""
+    links = {reference: url for reference, url, _ in daily_targets()}
+    dailies = []
+    for daily, src, sheets in fetch_dailies(links):
+        if sheets is None:
+            # Try again next time
+            continue
+        dailies.append((src, sheets))
+        if len(dailies) == DAILIES_BATCH:
+            write_dailies(dailies)
+            checkpoint()
+            dailies = []
+    if dailies:
+        write_dailies(dailies)
+
+def totals_frames(src, prefix):
+    """Read, clean and reshape a totals workbook into long form, along with the summaries.
+
+    Returns the frames to write, as a list of (table, dataframe)."""
+    sheets = read_totals(src)
+    frames = []
+    for sheet, kind in sheet_kinds(sheets):
+        _table = f'{prefix}_{kind}'
+        if kind in idx:
+            idx_cols = idx[kind]
+            df_long, _ = melt_lag([sheets[sheet]], idx_cols,
+                                  ['Awaiting verification', 'Total', 'Up to 01-Mar-20'], _table)
+            frames.append((_table, df_long))
+
+            cols = idx_cols + ['Up to 01-Mar-20', 'Awaiting verification', 'Total']
+            frames.append((f'{_table}_summary', sheets[sheet][cols]))
+        else:
+            frames.append((_table, sheets[sheet]))
+    return frames
+
+def ingest_totals(src, frames):
+    """Add a totals workbook to the db, replacing the previous version's rows."""
+    produced = {}
+    forget_source(src.reference)
+    for table, df in frames:
+        write_table(df, table, produced)
+    record_source(src, produced)
+
+def totals_targets(ledger=None):
+    """The totals workbooks, as (reference, url, link text).
+
+    These are checked for changes whatever the ledger says."""
+    _, totals, weekly_totals = nhs_links()
+    targets = []
+    for reference, (link, link_text) in zip(TOTALS_REFERENCES, [totals, weekly_totals]):
+        if not link:
+            print(f"No link found for {reference}")
+            continue
+        targets.append((reference, link, link_text))
+    return targets
+
+def update_totals():
+    """Ingest the totals and weekly totals workbooks, if they have changed.
+
+    Each workbook is committed as soon as it's in, so a bad one doesn't cost us the other: if
+    one fails, the other is still tried, and a RuntimeError raised once both have been."""
+    failed = []
+    for reference, link, link_text in totals_targets():
+        try:
+            with checkpointed():
+                src = fetch_source(reference, link, link_text)
+                if src:
+                    prefix = TOTALS_REFERENCES[reference]
+                    ingest_totals(src, cached_frames(src, prefix, PARSER_VERSION,
+                                                     lambda src: totals_frames(src, prefix)))
+        except Exception:
+            traceback.print_exc()
+            failed.append(reference)
+    if failed:
+        raise RuntimeError(f"Couldn't ingest {', '.join(failed)}")
@@ -0,0 +1,139 @@
+"""Normalised storage.
+
+The long-format tables repeat the full trust, region and age group names (or the ONS measure,
+group and age) on every row. Setting `NHS_NORMALISED_STORAGE=1` stores them in a much more
+compact form instead:
+
+- *dimension* tables (`dim_region`, `dim_trust`, `dim_age_group`, `dim_ons_group`,
+  `dim_ons_measure`) list each distinct trust, region etc. once, with an integer id;
+- narrow *fact* tables (`nhs_dailies_trust_facts`, `ons_deaths_facts` etc.) hold just the integer
+  ids, dates as integer day offsets from `DAY_ZERO`, and the integer values;
+- views with the original table names (`nhs_dailies_trust`, `ons_deaths` etc.) join the two back
+  together (working out the reporting lag from the dates), so existing queries and Datasette URLs
+  still work.
+
+Switching storage mode requires rebuilding the database from scratch.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from . import db
+from .db import table_schemas, unique_keys, write_table
+
+NORMALISED_STORAGE = os.environ.get('NHS_NORMALISED_STORAGE') == '1'
+DAY_ZERO = pd.Timestamp('2020-01-01')
+
+dimensions = {'dim_region': {'name': 'TEXT'},
+              'dim_trust': {'region_id': 'INTEGER', 'code': 'TEXT', 'name': 'TEXT'},
+              'dim_age_group': {'name': 'TEXT'},
+              'dim_ons_group': {'name': 'TEXT'},
+              'dim_ons_measure': {'name': 'TEXT'}}
+
+fact_tables = {'ons_deaths': 'ons'}
+for prefix in ['nhs_dailies', 'nhs_totals', 'nhs_weekly_totals']:
+    for table in ['trust', 'region', 'age']:
+        fact_tables[f'{prefix}_{table}'] = table
+
+fact_keys = {'trust': ['trust_id'], 'region': ['region_id'], 'age': ['age_group_id'],
+             'ons': ['measure_id', 'ons_group_id', 'age_group_id']}
+for table, kind in fact_tables.items():
+    days = ['day'] if kind == 'ons' else ['published_day', 'day']
+    table_schemas[f'{table}_facts'] = {c: 'INTEGER' for c in fact_keys[kind] + days + ['value']}
+    if table in unique_keys:
+        unique_keys[f'{table}_facts'] = fact_keys[kind] + days
+
+def day_sql(column):
+    """SQL for converting a day offset back into a timestamp."""
+    return f"datetime('{DAY_ZERO:%Y-%m-%d}', {column} || ' days')"
+
+def fact_view_sql(table, kind):
+    """SQL for the view that presents a fact table in its original long format.
+
+    The reporting lag is just the days between the publication date and the date, so it's
+    worked out here rather than stored. Like the tables, the view has the fact table's `rowid`
+    (which the ledger notes rows by)."""
+    facts = f'[{table}_facts]'
+    published = f"{day_sql('f.published_day')} AS [Published], "
+    date_value_lag = f"{day_sql('f.day')} AS [Date], f.value AS [value], f.published_day - f.day AS [lag]"
+    if kind == 'trust':
+        return (f"SELECT f.rowid AS [rowid], r.name AS [NHS England Region], t.code AS [Code], t.name AS [Name], "
+                f"{published}{date_value_lag} FROM {facts} f "
+                f"JOIN dim_trust t ON t.id = f.trust_id JOIN dim_region r ON r.id = t.region_id")
+    elif kind == 'region':
+        return (f"SELECT f.rowid AS [rowid], r.name AS [NHS England Region], {published}{date_value_lag} "
+                f"FROM {facts} f JOIN dim_region r ON r.id = f.region_id")
+    elif kind == 'age':
+        return (f"SELECT f.rowid AS [rowid], a.name AS [Age group], {published}{date_value_lag} "
+                f"FROM {facts} f JOIN dim_age_group a ON a.id = f.age_group_id")
+    return (f"SELECT f.rowid AS [rowid], a.name AS [Age], {day_sql('f.day')} AS [Date], f.value AS [value], "
+            f"m.name AS [measure], g.name AS [Group] FROM {facts} f "
+            f"JOIN dim_age_group a ON a.id = f.age_group_id "
+            f"JOIN dim_ons_measure m ON m.id = f.measure_id "
+            f"JOIN dim_ons_group g ON g.id = f.ons_group_id")
+
+_dimension_cache = {}
+
+def dimension_ids(dimension, members):
+    """Get the ids for the members of a dimension (a dataframe of its key columns), adding any new ones."""
+    columns = list(dimensions[dimension])
+    if not db.DB[dimension].exists():
+        columns_sql = ', '.join(f'[{c}] {t}' for c, t in dimensions[dimension].items())
+        unique_sql = ', '.join(f'[{c}]' for c in columns)
+        db.DB.execute(f"CREATE TABLE [{dimension}] (id INTEGER PRIMARY KEY, {columns_sql}, UNIQUE ({unique_sql}))")
+    if dimension not in _dimension_cache:
+        columns_sql = ', '.join(f'[{c}]' for c in columns)
+        _dimension_cache[dimension] = {tuple(row[1:]): row[0] for row in
+                                       db.DB.execute(f"SELECT id, {columns_sql} FROM [{dimension}]")}
+    known = _dimension_cache[dimension]
+    members = members.astype(object).where(members.notna(), None)
+    keys = list(members.itertuples(index=False, name=None))
+    columns_sql = ', '.join(f'[{c}]' for c in columns)
+    params = ', '.join('?' for _ in columns)
+    for key in dict.fromkeys(keys):
+        if key not in known:
+            known[key] = db.DB.execute(f"INSERT INTO [{dimension}] ({columns_sql}) VALUES ({params})",
+                                       key).lastrowid
+    index = pd.MultiIndex.from_tuples(list(known)) if len(columns) > 1 else pd.Index([k[0] for k in known])
+    lookup = pd.MultiIndex.from_tuples(keys) if len(columns) > 1 else pd.Index([k[0] for k in keys])
+    return np.array(list(known.values()))[index.get_indexer(lookup)]
+
+def day_offsets(series):
+    """Convert a column of dates into integer day offsets from DAY_ZERO."""
+    return (pd.to_datetime(series) - DAY_ZERO).dt.days.astype('Int64')
+
+def write_facts(df, table, produced):
+    """Write a long-format table as a fact table plus dimensions, with a view in its original format."""
+    kind = fact_tables[table]
+    facts = pd.DataFrame(index=df.index)
+    if kind == 'trust':
+        region_ids = dimension_ids('dim_region', df[['NHS England Region']].rename(columns={'NHS England Region': 'name'}))
+        trusts = pd.DataFrame({'region_id': region_ids, 'code': df['Code'], 'name': df['Name']}, index=df.index)
+        facts['trust_id'] = dimension_ids('dim_trust', trusts)
+    elif kind == 'region':
+        facts['region_id'] = dimension_ids('dim_region', df[['NHS England Region']].rename(columns={'NHS England Region': 'name'}))
+    elif kind == 'age':
+        facts['age_group_id'] = dimension_ids('dim_age_group', df[['Age group']].rename(columns={'Age group': 'name'}))
+    else:
+        facts['measure_id'] = dimension_ids('dim_ons_measure', df[['measure']].rename(columns={'measure': 'name'}))
+        facts['ons_group_id'] = dimension_ids('dim_ons_group', df[['Group']].rename(columns={'Group': 'name'}))
+        facts['age_group_id'] = dimension_ids('dim_age_group', df[['Age']].rename(columns={'Age': 'name'}))
+    if kind != 'ons':
+        facts['published_day'] = day_offsets(df['Published'])
+    facts['day'] = day_offsets(df['Date'])
+    facts['value'] = pd.to_numeric(df['value']).astype('Int64')
+    write_table(facts, f'{table}_facts', produced)
+    if table in db.DB.table_names():
+        raise RuntimeError(f"{table} is stored as a table; rebuild the db to switch storage mode")
+    update_view(table)
+
+def update_view(table):
+    """Create the view for a fact table, replacing one made by an earlier version (which read a
+    stored lag, say)."""
+    view_sql = f"CREATE VIEW [{table}] AS {fact_view_sql(table, fact_tables[table])}"
+    existing = db.DB.execute("SELECT sql FROM sqlite_master WHERE type = 'view' AND name = ?", [table]).fetchone()
+    if existing and existing[0] != view_sql:
+        db.DB.execute(f"DROP VIEW [{table}]")
+    if not existing or existing[0] != view_sql:
+        db.DB.execute(view_sql)
@@ -0,0 +1,123 @@
+"""ONS death registrations and occurrences by local authority, 2020.
+
+https://www.ons.gov.uk/peoplepopulationandcommunity/healthandsocialcare/causesofdeath/datasets/deathregistrationsandoccurrencesbylocalauthorityandhealthboard
+
+The first cell of each data sheet describes the period it covers. Each release is upserted into
+the `ons_deaths_reg` and `ons_deaths_reg_occ` tables, which hold just the latest release.
+"""
+from parse import parse
+
+from . import db
+from .dates import parse_date
+from .db import upsert_table
+from .metrics import stage
+from .parse_cache import cached_frames
+from .sheets import ANCHOR_MAX_ROWS, anchor_index, read_sheets, sheet_dtypes, typed_sheet
+from .sources import download_source, fetch_source, record_source, scrape
+
+LANDING_PAGE = 'https://www.ons.gov.uk/peoplepopulationandcommunity/healthandsocialcare/causesofdeath/datasets/deathregistrationsandoccurrencesbylocalauthorityandhealthboard'
+# We only need the links from the page
+LANDING_PAGE_LINKS = {'name': 'a'}
+
+def ons_death_reg_link():
+    """Find the link to the latest workbook, and its link text."""
+    for link in scrape(LANDING_PAGE, LANDING_PAGE_LINKS).find_all('a'):
+        if 'Download Death registrations and occurrences' in link.text:
+            return f'https://www.ons.gov.uk{link.get("href")}', link.text.strip()
+    return 'https://www.ons.gov.uk', ''
+
+def ons_death_registrations(ons_death_reg):
+    """Clean the ONS death registrations sheet."""
+    ons_death_reg_metadata = ons_death_reg.iloc[0, 0]
+    upto = parse('Deaths (numbers) by local authority and cause of death, registered up to the {date}, England and Wales',
+                 ons_death_reg_metadata)['date']
+    upto = parse_date(upto)
+
+    rows, cols = anchor_index(ons_death_reg, ['Area code'], max_rows=ANCHOR_MAX_ROWS)['Area code']
+    colnames = ons_death_reg.iloc[rows[0]].tolist()
+
+    ons_death_reg = ons_death_reg.iloc[rows[0]+1:].reset_index(drop=True)
+    ons_death_reg.columns = colnames
+    ons_death_reg = typed_sheet(ons_death_reg, sheet_dtypes['ons death registrations'])
+
+    ons_death_reg['Registered up to'] = upto
+    return ons_death_reg
+
+def ons_death_occurrences(ons_death_occ):
+    """Clean the ONS death occurrences sheet."""
+    ons_death_occ_metadata = ons_death_occ.iloc[0, 0]
+    uptos = parse('Deaths (numbers) by local authority and cause of death, for deaths that occurred up to {date_occ} but were registered up to {date_reg}, England and Wales',
+                 ons_death_occ_metadata)
+
+    upto_occ = uptos['date_occ']
+    if '2020' not in upto_occ: upto_occ = f'{upto_occ} 2020'
+
+    upto_reg = uptos['date_reg']
+    if '2020' not in upto_occ: upto_occ = f'{upto_reg} 2020'
+
+    upto_occ = parse_date(upto_occ)
+    upto_reg = parse_date(upto_reg)
+
+    rows, cols = anchor_index(ons_death_occ, ['Area code'], max_rows=ANCHOR_MAX_ROWS)['Area code']
+    colnames = ons_death_occ.iloc[rows[0]].tolist()
+
+    ons_death_occ = ons_death_occ.iloc[rows[0]+1:].reset_index(drop=True)
+    ons_death_occ.columns = colnames
+    ons_death_occ = typed_sheet(ons_death_occ, sheet_dtypes['ons death registrations'])
+
+    ons_death_occ['Occurred up to'] = upto_occ
+    ons_death_occ['Registered up to'] = upto_reg
+    return ons_death_occ
+
+# Bump this whenever the reading or cleaning of the workbook changes (see `parse_cache`)
+PARSER_VERSION = 2
+
+def ons_death_reg_frames(src):
+    """Read and clean the ONS death registrations and occurrences sheets."""
+    with stage('read_excel', src.reference) as metric:
+        metric['bytes'] = len(src.content)
+        _, ons_reg_sheets = read_sheets(src.content, wanted=['Registrations - All data',
+                                                             'Occurrences - All data'])
+        metric['rows'] = sum(len(sheet) for sheet in ons_reg_sheets.values())
+    with stage('cleaner', src.reference) as metric:
+        ons_death_reg = ons_death_registrations(ons_reg_sheets['Registrations - All data'])
+        ons_death_occ = ons_death_occurrences(ons_reg_sheets['Occurrences - All data'])
+        metric['rows'] = len(ons_death_reg) + len(ons_death_occ)
+    return [('ons_deaths_reg', ons_death_reg), ('ons_deaths_reg_occ', ons_death_occ)]
+
+def ingest_ons_death_reg(src):
+    """Add the ONS death registrations and occurrences to the database."""
+    frames = cached_frames(src, 'ons_registrations', PARSER_VERSION, ons_death_reg_frames)
+    produced = {}
+    for table, df in frames:
+        upsert_table(df, table, produced)
+    record_source(src, produced)
+
+def targets(ledger=None):
+    """The sources to download, as (reference, url, link text).
+
+    The workbook is checked for changes whatever the ledger says."""
+    url, link_text = ons_death_reg_link()
+    return [('ONS death registrations', url, link_text)]
+
+def stacked_releases():
+    """Whether the tables hold more than one release.
+
+    They could, before they were keyed without the release date."""
+    return any(db.DB[table].exists() and
+               db.DB.execute(f"SELECT COUNT(DISTINCT [Registered up to]) FROM [{table}]").fetchone()[0] > 1
+               for table in ['ons_deaths_reg', 'ons_deaths_reg_occ'])
+
+def update():
+    """Ingest the ONS death registrations workbook, if it has changed since we last ingested it."""
+    [(reference, url, link_text)] = targets()
+    if not stacked_releases():
+        src = fetch_source(reference, url, link_text)
+    else:
+        # Take the latest release again, even if it hasn't changed, which replaces the old ones
+        src = download_source(reference, url, link_text)
+        if src.content is None:
+            # Prefetched with a conditional request
+            src = download_source(reference, url, link_text)
+    if src:
+        ingest_ons_death_reg(src)
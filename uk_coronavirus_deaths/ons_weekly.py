@@ -0,0 +1,107 @@
+"""ONS weekly provisional deaths.
+
+https://www.ons.gov.uk/peoplepopulationandcommunity/birthsdeathsandmarriages/deaths/datasets/weeklyprovisionalfiguresondeathsregisteredinenglandandwales
+
+The workbook has sheets for weekly registrations, occurrences and all-cause mortality. Each
+sheet holds a table of weekly counts by age group for each of *Persons*, *Males* and *Females*.
+The tables are each reshaped into long form and then stacked together in one go, using compact
+types: categories for the age group, group and measure, datetimes for the dates, and integer
+counts. The result is added to the `ons_deaths` table, replacing any rows from a previous
+version of the workbook.
+"""
+import pandas as pd
+
+from .db import write_table
+from .metrics import stage
+from .parse_cache import cached_frames
+from .sheets import anchor_index, read_sheets, sheet_dtypes, typed_sheet
+from .sources import fetch_source, forget_source, record_source, scrape
+
+LANDING_PAGE = 'https://www.ons.gov.uk/peoplepopulationandcommunity/birthsdeathsandmarriages/deaths/datasets/weeklyprovisionalfiguresondeathsregisteredinenglandandwales'
+# We only need the links from the page
+LANDING_PAGE_LINKS = {'name': 'a'}
+
+def ons_weekly_link():
+    """Find the link to the latest workbook, and its link text."""
+    for link in scrape(LANDING_PAGE, LANDING_PAGE_LINKS).find_all('a'):
+        if 'Download Deaths registered weekly' in link.text:
+            return f'https://www.ons.gov.uk{link.get("href")}', link.text.strip()
+    return 'https://www.ons.gov.uk', ''
+
+def ons_weeklies(ons_weekly, typ):
+    """Reshape a sheet of the ONS weekly workbook into long form, for each group and overall."""
+    anchors = anchor_index(ons_weekly, ['Week ended', 'Deaths by age group', '90+'])
+    rows, cols = anchors['Week ended']
+    colnames = ons_weekly.iloc[rows[0]].tolist()
+    colnames[1] = 'Age'
+    rows, cols = anchors['Deaths by age group']
+    _rows, _ = anchors['90+']
+
+    #Get the first three tables - for Persons, Males and Females
+    tables = [ons_weekly.iat[r-1, c].split()[0] for r, c in zip(rows, cols)]
+    frames = []
+    for r, _r, t in zip(rows, _rows, tables):
+        block = ons_weekly.iloc[r+1: _r+1].copy()
+        block.columns = colnames
+        block = block.dropna(axis=1, how='all')
+        dropper = [c for c in block.columns if 'to date' in str(c) or '1 to' in str(c)]
+        block = typed_sheet(block.drop(columns=dropper), sheet_dtypes['ons weekly'])
+        block = block.melt(id_vars=['Age'], var_name='Date', value_name='value')
+        block['measure'] = typ
+        block['Group'] = t
+        frames.append(block)
+
+    ons_weekly_all = pd.concat(frames, ignore_index=True)
+    ons_weekly_all['Date'] = pd.to_datetime(ons_weekly_all['Date'])
+    ons_weekly_all['value'] = pd.to_numeric(ons_weekly_all['value']).astype('Int64')
+    for c in ['Age', 'measure', 'Group']:
+        ons_weekly_all[c] = ons_weekly_all[c].astype('category')
+
+    ons_weekly_long = {t: df for t, df in ons_weekly_all.groupby('Group', sort=False, observed=True)}
+    ons_weekly_long['Any'] = ons_weekly_all
+    return ons_weekly_long
+
+ons_weekly_sheets = {'Covid-19 - Weekly occurrences': 'Weekly occurrences',
+                     'Covid-19 - Weekly registrations': 'Weekly registrations',
+                     'Weekly figures 2020': 'Weekly all mortality'}
+
+# Bump this whenever the reading or reshaping of the workbook changes (see `parse_cache`)
+PARSER_VERSION = 2
+
+def ons_weekly_frames(src):
+    """Read the ONS weekly workbook, and reshape its sheets into long form."""
+    with stage('read_excel', src.reference) as metric:
+        metric['bytes'] = len(src.content)
+        _, ons_sheets = read_sheets(src.content, wanted=ons_weekly_sheets)
+        metric['rows'] = sum(len(sheet) for sheet in ons_sheets.values())
+    frames = []
+    for sheet, typ in ons_weekly_sheets.items():
+        with stage('melt', f'{src.reference}: {sheet}') as metric:
+            ons_weekly_long = ons_weeklies(ons_sheets[sheet], typ)
+            metric['rows'] = len(ons_weekly_long['Any'])
+        frames.append(('ons_deaths', ons_weekly_long['Any']))
+    return frames
+
+def ingest_ons_weekly(src):
+    """Reshape the ONS weekly workbook into the ons_deaths table."""
+    frames = cached_frames(src, 'ons_weekly', PARSER_VERSION, ons_weekly_frames)
+    produced = {}
+    forget_source(src.reference)
+    for table, df in frames:
+        write_table(df, table, produced)
+    record_source(src, produced)
+
+def targets(ledger=None):
+    """The sources to download, as (reference, url, link text).
+
+    The workbook is checked for changes whatever the ledger says."""
+    url, link_text = ons_weekly_link()
+    return [('ONS weekly deaths', url, link_text)]
+
+def update():
+    """Ingest the ONS weekly workbook, if it has changed since we last ingested it."""
+    [(reference, url, link_text)] = targets()
+    print(url)
+    src = fetch_source(reference, url, link_text)
+    if src:
+        ingest_ons_weekly(src)
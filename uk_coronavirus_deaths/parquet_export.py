@@ -0,0 +1,100 @@
+"""Parquet export.
+
+For analytic work, the tables are also exported as Parquet files in `PARQUET_DIR` (`parquet` by
+default; set it to an empty string to skip the export), with text columns dictionary encoded.
+The long NHS tables are partitioned by the month they were published in, and `ons_deaths` by
+measure, in hive style directories (for example,
+`parquet/nhs_dailies_trust/published_month=2020-04/part-0.parquet`). They can be opened with
+`pyarrow.dataset` or `pd.read_parquet()`, and filtered on the partitions and columns without
+reading everything else. Other tables are exported as a single file each
+(`parquet/phe_cases.parquet`).
+
+A table is only exported if it was written to during this run (or hasn't been exported yet), and
+tables are read from the database a partition at a time.
+"""
+import os
+import shutil
+from urllib.parse import quote
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from . import db, normalised
+from .db import nhs_index_columns, table_schemas, tables_written
+from .metrics import stage
+
+PARQUET_DIR = os.environ.get('PARQUET_DIR', 'parquet')
+
+parquet_partitions = {'ons_deaths': ('measure', '[measure]')}
+for prefix in ['nhs_dailies', 'nhs_totals', 'nhs_weekly_totals']:
+    for table in nhs_index_columns:
+        parquet_partitions[f'{prefix}_{table}'] = ('published_month', "strftime('%Y-%m', [Published])")
+
+arrow_types = {'TEXT': pa.dictionary(pa.int32(), pa.string()), 'INTEGER': pa.int64(),
+               'REAL': pa.float64(), 'FLOAT': pa.float64(), 'TIMESTAMP': pa.timestamp('ns')}
+
+def parquet_tables():
+    """The tables (and views) we publish."""
+    for table in db.DB.table_names() + db.DB.view_names():
+        if (table in ('processed', 'run_metrics', 'nhs_lag_sources') or table.startswith('sqlite_')
+                or '_fts' in table or table.endswith('_staging')
+                or (normalised.NORMALISED_STORAGE and (table.startswith('dim_') or table.endswith('_facts')))):
+            continue
+        yield table
+
+def parquet_frame(table, column_types, where='', params=()):
+    """Read (part of) a table, with its columns converted to suit their Arrow types."""
+    _df = pd.read_sql(f"SELECT * FROM [{table}] {where}", db.DB.conn, params=params)
+    # The rowid is just for the ledger
+    _df = _df.drop(columns=['rowid'], errors='ignore')
+    for c in _df.columns:
+        if column_types.get(c) == 'TIMESTAMP':
+            _df[c] = pd.to_datetime(_df[c])
+        elif _df[c].dtype == object and pd.api.types.infer_dtype(_df[c], skipna=True) not in ('string', 'empty'):
+            _df[c] = _df[c].map(lambda v: v if v is None else str(v))
+    return _df
+
+def export_parquet(table, out_dir=None):
+    """Export a table to Parquet, replacing any previous export of it."""
+    out_dir = out_dir or PARQUET_DIR
+    column_types = {c.name: c.type.upper() for c in db.DB[table].columns}
+    column_types.update(table_schemas.get(table, {}))
+    def arrow_type(_df, c):
+        if column_types.get(c) in arrow_types:
+            return arrow_types[column_types[c]]
+        elif _df[c].dtype == object:
+            return arrow_types['TEXT']
+        return pa.Array.from_pandas(_df[c]).type
+    def write(_df, path):
+        # Use the declared column types, so the schema is the same in every partition
+        schema = pa.schema([(c, arrow_type(_df, c)) for c in _df.columns])
+        pq.write_table(pa.Table.from_pandas(_df, schema=schema, preserve_index=False), path,
+                       use_dictionary=True, compression='snappy')
+    final = os.path.join(out_dir, table if table in parquet_partitions else f'{table}.parquet')
+    tmp = os.path.join(out_dir, f'.{os.path.basename(final)}.tmp')
+    if table not in parquet_partitions:
+        write(parquet_frame(table, column_types), tmp)
+        os.replace(tmp, final)
+        return
+    name, expr = parquet_partitions[table]
+    shutil.rmtree(tmp, ignore_errors=True)
+    for (value,) in db.DB.execute(f"SELECT DISTINCT {expr} FROM [{table}]").fetchall():
+        partition = os.path.join(tmp, f'{name}={quote(str(value), safe="")}')
+        os.makedirs(partition)
+        _df = parquet_frame(table, column_types, f"WHERE {expr} IS ?", [value])
+        # A partition column is read back from the directory name, so it isn't stored in the file
+        write(_df.drop(columns=[name], errors='ignore'), os.path.join(partition, 'part-0.parquet'))
+    shutil.rmtree(final, ignore_errors=True)
+    os.replace(tmp, final)
+
+def export_database(out_dir=None):
+    """Export the tables that have changed to Parquet."""
+    out_dir = out_dir or PARQUET_DIR
+    os.makedirs(out_dir, exist_ok=True)
+    for table in parquet_tables():
+        exported = os.path.exists(os.path.join(out_dir, table)) or os.path.exists(os.path.join(out_dir, f'{table}.parquet'))
+        if exported and table not in tables_written and f'{table}_facts' not in tables_written:
+            continue
+        with stage('parquet', table=table):
+            export_parquet(table, out_dir)
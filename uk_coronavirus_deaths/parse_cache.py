@@ -0,0 +1,120 @@
+"""A cache of parsed sources.
+
+Reading and cleaning a workbook, and reshaping it into long form, is by far the slowest part of
+ingesting it. The frames a workbook is turned into are cached on disk as Arrow (Feather) files,
+keyed on the SHA-256 of the workbook and the version of the parser that produced them, so if we
+see the same bytes again (when the db is rebuilt from scratch, say, or a workbook is republished
+unchanged under a new link) they are loaded in milliseconds instead of being parsed again. Bump
+a feed's `PARSER_VERSION` whenever its parsing changes, so that stale frames aren't used.
+
+The cache lives in `PARSE_CACHE_DIR` (`.parse_cache` by default; set it to an empty string to
+turn the cache off). It is bounded in size, and the least recently used entries are evicted
+first.
+"""
+import os
+import json
+import shutil
+import threading
+
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+
+from .metrics import stage
+
+PARSE_CACHE_DIR = os.environ.get('PARSE_CACHE_DIR', '.parse_cache')
+PARSE_CACHE_MAX_BYTES = int(os.environ.get('PARSE_CACHE_MAX_BYTES', 1024 ** 3))
+
+def _parse_cache_path(sha256, name, version):
+    return os.path.join(PARSE_CACHE_DIR, f'{sha256}-{name}-v{version}')
+
+def arrow_frame(df):
+    """Get a copy of a frame that round trips exactly through Arrow, or None if there isn't one.
+
+    Object columns of numbers with gaps would come back as floats, so they're made nullable
+    integers; columns that mix numbers and text can't be stored as they are."""
+    columns = [str(c) for c in df.columns]
+    if len(set(columns)) < len(columns):
+        return None
+    df = df.set_axis(columns, axis=1).reset_index(drop=True)
+    for c in columns:
+        if df[c].dtype != object:
+            continue
+        inferred = pd.api.types.infer_dtype(df[c], skipna=True)
+        if inferred == 'integer':
+            df[c] = df[c].astype('Int64')
+        elif inferred not in ('string', 'empty', 'floating', 'mixed-integer-float', 'boolean',
+                              'datetime'):
+            return None
+    return df
+
+def load_frames(sha256, name, version):
+    """Get the frames cached for a source, or None if they aren't in the cache."""
+    if not PARSE_CACHE_DIR or not sha256:
+        return None
+    path = _parse_cache_path(sha256, name, version)
+    manifest = os.path.join(path, 'manifest.json')
+    if not os.path.exists(manifest):
+        return None
+    with stage('parse_cache', name) as metric:
+        with open(manifest) as f:
+            tables = json.load(f)
+        frames = [(table, feather.read_table(os.path.join(path, f'{i}.arrow')).to_pandas())
+                  for i, table in enumerate(tables)]
+        metric['bytes'] = sum(os.path.getsize(os.path.join(path, f'{i}.arrow')) for i in range(len(tables)))
+        metric['rows'] = sum(len(df) for _, df in frames)
+    # Mark the entry as recently used
+    os.utime(manifest)
+    return frames
+
+def store_frames(sha256, name, version, frames):
+    """Add the frames parsed from a source to the cache (unless they can't be stored exactly)."""
+    if not PARSE_CACHE_DIR or not sha256:
+        return
+    ready = [(table, arrow_frame(df)) for table, df in frames]
+    if any(df is None for _, df in ready):
+        return
+    try:
+        tables = [pa.Table.from_pandas(df, preserve_index=False) for _, df in ready]
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Categories of mixed types, say
+        return
+    path = _parse_cache_path(sha256, name, version)
+    # Write to a temporary directory and swap it in, so a reader never sees a partial entry
+    tmp = f'{path}.{threading.get_ident()}.tmp'
+    os.makedirs(tmp, exist_ok=True)
+    for i, table in enumerate(tables):
+        feather.write_feather(table, os.path.join(tmp, f'{i}.arrow'))
+    with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+        json.dump([table for table, _ in ready], f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    parse_cache_evict()
+
+def parse_cache_evict(max_bytes=None):
+    """Remove least recently used cache entries until the cache fits in max_bytes."""
+    max_bytes = max_bytes or PARSE_CACHE_MAX_BYTES
+    entries = []
+    for entry in os.listdir(PARSE_CACHE_DIR):
+        path = os.path.join(PARSE_CACHE_DIR, entry)
+        manifest = os.path.join(path, 'manifest.json')
+        if not os.path.exists(manifest):
+            continue
+        size = sum(os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path))
+        entries.append((os.path.getmtime(manifest), size, path))
+    total = sum(e[1] for e in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+def cached_frames(src, name, version, parse):
+    """Get the frames parsed from a source, parsing it only if it isn't in the cache.
+
+    `parse(src)` returns the frames as a list of (table, dataframe)."""
+    frames = load_frames(src.sha256, name, version)
+    if frames is None:
+        frames = parse(src)
+        store_frames(src.sha256, name, version, frames)
+    return frames
@@ -0,0 +1,116 @@
+"""Public Health England cases and deaths.
+
+- [Cases](https://coronavirus.data.gov.uk/downloads/csv/coronavirus-cases_latest.csv)
+- [Deaths](https://coronavirus.data.gov.uk/downloads/csv/coronavirus-deaths_latest.csv)
+
+The national CSVs keep growing, so by default they're streamed: the response is parsed a chunk of
+rows at a time as it arrives, each chunk is appended to a staging table, and once the whole file
+has been read the staging table is merged into the old one (or swapped in for it, if we aren't
+upserting). Set `PHE_STREAMING=0` to read each CSV in one go instead.
+"""
+#via https://stackoverflow.com/questions/61415090/python-pandas-handling-of-308-request
+# (the HTTP cache follows the redirect for us)
+import os
+import traceback
+
+import pandas as pd
+
+from . import db
+from .db import max_rowid, merge_staged, tables_written, upsert_keys, upsert_table, write_table
+from .metrics import stage
+from .sources import (BufferReader, changed_source, fetch_source, ledger_entry, record_source,
+                      stream_source)
+
+PHE_CASES_URL = 'https://coronavirus.data.gov.uk/downloads/csv/coronavirus-cases_latest.csv'
+PHE_DEATHS_URL = 'https://coronavirus.data.gov.uk/downloads/csv/coronavirus-deaths_latest.csv'
+
+PHE_STREAMING = os.environ.get('PHE_STREAMING', '1') == '1'
+PHE_CHUNKSIZE = int(os.environ.get('PHE_CHUNKSIZE', 100000))
+
+phe_dtypes = {'Area name': str, 'Area code': str, 'Area type': str}
+phe_date_columns = ['Specimen date', 'Reporting date']
+
+def phe_dates(_df):
+    """Parse the date columns of a PHE CSV."""
+    for c in phe_date_columns:
+        if c in _df.columns:
+            _df[c] = pd.to_datetime(_df[c])
+    return _df
+
+def get_308_csv(src):
+    """Read a PHE CSV."""
+    with BufferReader(src.content) as data_file, stage('read_csv', src.reference) as metric:
+        _df = phe_dates(pd.read_csv(data_file, dtype=phe_dtypes))
+        metric['rows'] = len(_df)
+    return _df
+
+def ingest_phe_csv(src, _table):
+    """Replace a PHE table with the contents of the latest CSV."""
+    _df = get_308_csv(src)
+    produced = {}
+    upsert_table(_df, _table, produced)
+    record_source(src, produced)
+    return _df
+
+def stream_phe_csv(reference, url, _table, chunksize=None):
+    """Replace a PHE table with the latest CSV, streaming it in via a staging table.
+
+    Returns the first chunk of the CSV, or None if the source is unchanged."""
+    chunksize = chunksize or PHE_CHUNKSIZE
+    seen = ledger_entry(reference)
+    src, body = stream_source(reference, url, seen=seen)
+    if body is None:
+        return changed_source(src, seen)
+    staging = f'{_table}_staging'
+    head = None
+    with body, stage('stream_csv', reference, staging) as metric:
+        metric['rows'] = 0
+        for i, chunk in enumerate(pd.read_csv(body, chunksize=chunksize, dtype=phe_dtypes)):
+            write_table(phe_dates(chunk), staging, {}, if_exists='replace' if i == 0 else 'append')
+            metric['rows'] += len(chunk)
+            if head is None:
+                head = chunk.head()
+        metric['bytes'] = body.size
+        src = src._replace(sha256=body.sha256.hexdigest())
+    if changed_source(src, seen) is None:
+        db.DB.execute(f"DROP TABLE IF EXISTS [{staging}]")
+        return None
+    # We're inside the load transaction, so nobody sees the table part way through
+    produced = {}
+    if db.DELTA_UPSERT:
+        merge_staged(staging, _table, upsert_keys[_table], produced)
+    else:
+        db.DB.execute(f"DROP TABLE IF EXISTS [{_table}]")
+        db.DB.execute(f"ALTER TABLE [{staging}] RENAME TO [{_table}]")
+        tables_written.add(_table)
+        produced[_table] = [[1, max_rowid(_table)]]
+    record_source(src, produced)
+    return head
+
+def update_phe_csv(reference, url, _table):
+    """Update a PHE table from the latest CSV, if it has changed."""
+    if PHE_STREAMING:
+        return stream_phe_csv(reference, url, _table)
+    src = fetch_source(reference, url)
+    if src:
+        return ingest_phe_csv(src, _table)
+
+def update():
+    """Update the PHE cases and deaths tables, if the CSVs have changed.
+
+    Each CSV is committed as soon as it's in, so a bad one doesn't cost us the other: if one
+    fails, the other is still tried, and a RuntimeError raised once both have been.
+    Returns the CSV (or when streaming, its first chunk) for each table, or None if it's unchanged."""
+    heads = {}
+    failed = []
+    for reference, url, _table in [('PHE cases', PHE_CASES_URL, 'phe_cases'),
+                                   ('PHE deaths', PHE_DEATHS_URL, 'phe_deaths')]:
+        try:
+            with db.checkpointed():
+                heads[_table] = update_phe_csv(reference, url, _table)
+        except Exception:
+            traceback.print_exc()
+            failed.append(reference)
+    if failed:
+        raise RuntimeError(f"Couldn't ingest {', '.join(failed)}")
+    return heads
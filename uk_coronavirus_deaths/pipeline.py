@@ -0,0 +1,131 @@
+"""Running the pipeline.
+
+A run opens the db and sets it up for a bulk load. The sources are discovered and downloaded
+concurrently (see `discovery`), then each of them is ingested in turn, the reporting lag
+aggregates are updated and the db is indexed. The db is compacted, the changed tables exported
+to Parquet, and the run metrics saved. A run can be limited to some of the sources, or some of
+the stages; the modules for the sources (and stages) that aren't run are never imported.
+
+A run can also be built in a staging copy of the db, and only published over the live db once
+it's finished and been checked (see `publish`).
+
+Each source is committed as soon as it has been ingested (see `db.checkpointed()`). If one of
+them fails, it's rolled back and the run carries on with the rest, so that what did load is
+published; the run then fails once it's finished. Sources that aren't in the ledger are tried
+again next time.
+"""
+import os
+import importlib
+import traceback
+
+from . import db, metrics
+from .metrics import stage
+
+# The sources in the order they're ingested, and the function that ingests each of them
+SOURCES = {'ons-weekly': ('ons_weekly', 'update'),
+           'ons-registrations': ('ons_registrations', 'update'),
+           'nhs-dailies': ('nhs', 'update_dailies'),
+           'nhs-totals': ('nhs', 'update_totals'),
+           'phe': ('phe', 'update')}
+
+# The function that finds the sources to download for each source that has a landing page
+DISCOVERY = {'ons-weekly': ('ons_weekly', 'targets'),
+             'ons-registrations': ('ons_registrations', 'targets'),
+             'nhs-dailies': ('nhs', 'daily_targets'),
+             'nhs-totals': ('nhs', 'totals_targets')}
+
+STAGES = ['ingest', 'aggregate', 'index', 'export']
+
+def discover(sources):
+    """Scrape the sources' landing pages, and prefetch the sources found on them."""
+    from . import discovery
+    pages = {}
+    for source in sources:
+        if source not in DISCOVERY:
+            continue
+        module, function = DISCOVERY[source]
+        module = importlib.import_module(f'.{module}', __package__)
+        _, finders = pages.setdefault(module.LANDING_PAGE, (module.LANDING_PAGE_LINKS, []))
+        finders.append(getattr(module, function))
+    discovery.discover(pages)
+
+def ingest(source):
+    """Ingest a source, if it has changed since we last ingested it, and commit it."""
+    module, function = SOURCES[source]
+    with db.checkpointed():
+        return getattr(importlib.import_module(f'.{module}', __package__), function)()
+
+def aggregate():
+    """Update the reporting lag aggregates."""
+    from . import aggregates
+    with db.checkpointed():
+        aggregates.update()
+
+def index():
+    """Index the db."""
+    from . import indexes
+    with stage('index'):
+        indexes.index_database()
+
+def finish():
+    """Commit everything we've loaded, and compact the database before it's published."""
+    with stage('vacuum'):
+        db.end_bulk_load()
+        db.DB.execute("VACUUM")
+
+def export():
+    """Export the tables that have changed to Parquet (unless `PARQUET_DIR` is empty)."""
+    if not os.environ.get('PARQUET_DIR', 'parquet'):
+        return
+    from . import parquet_export
+    with stage('parquet_export'):
+        parquet_export.export_database()
+
+def run(sources=None, stages=None, path=None, staging=None):
+    """Run the pipeline, for all the sources and stages by default.
+
+    With staging (by default, if `NHS_PUBLISH_STAGING=1`), the db is built in a staging copy
+    and published over the live db at the end of the run (see `publish`).
+
+    Returns the run metrics summary, or None if `RUN_METRICS_JSON` is empty. If any of the
+    sources couldn't be ingested, raises a RuntimeError once the rest of the run is done."""
+    sources = list(SOURCES) if sources is None else sources
+    stages = STAGES if stages is None else stages
+    path = path or db.DB_PATH
+    if staging is None:
+        staging = os.environ.get('NHS_PUBLISH_STAGING') == '1'
+    staging_db = None
+    if staging:
+        from . import publish
+        staging_db = publish.begin_staging(path)
+    db.connect(staging_db or path)
+    db.begin_bulk_load()
+    failed = []
+    if 'ingest' in stages:
+        discover(sources)
+        for source in SOURCES:
+            if source not in sources:
+                continue
+            try:
+                ingest(source)
+            except Exception:
+                traceback.print_exc()
+                print(f"Couldn't ingest {source}; whatever of it wasn't committed has been rolled back")
+                failed.append(source)
+    if 'aggregate' in stages:
+        aggregate()
+    if 'index' in stages:
+        index()
+    finish()
+    if staging_db:
+        # Before the export, so a build that's rejected never reaches parquet/ either
+        publish.prepare(path, staging_db, analyze='index' not in stages)
+    if 'export' in stages:
+        export()
+    summary = metrics.save_run_metrics() if metrics.RUN_METRICS_JSON else None
+    if staging_db:
+        db.DB.conn.close()
+        publish.publish(path, staging_db)
+    if failed:
+        raise RuntimeError(f"Couldn't ingest {', '.join(failed)}")
+    return summary
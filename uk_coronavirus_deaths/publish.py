@@ -0,0 +1,78 @@
+"""Publishing the db.
+
+By default a run loads straight into the db. Anything reading it while the run is going (the
+Datasette deploy, say, or a notebook) can then see a half loaded table, or be locked out while a
+source is being written. In publishing mode (`--staging`, or `NHS_PUBLISH_STAGING=1`) the run
+is built in a staging db instead, and only swapped in for the live db once it's finished:
+
+- the staging db starts as a snapshot of the live db, taken with SQLite's backup API, which
+  copies a consistent version of it without blocking its readers;
+- the run loads into the staging db;
+- the staging db is validated (an integrity check, and no table that has rows in the live db may
+  have lost all of them, or gone missing) and analysed for the query planner, before anything is
+  exported from it to Parquet;
+- and it's renamed over the live db, in one atomic step.
+
+Readers that open the live db see either the old version or the new one, never anything in
+between; readers that already have it open carry on with the old version until they reopen it.
+If the run fails before it's published, the live db is left as it was, and the staging db kept
+for a look.
+"""
+import os
+import sqlite3
+from contextlib import closing
+
+from .metrics import stage
+
+def staging_path(path):
+    """The path of the staging db for a live db."""
+    return f'{path}.staging'
+
+def table_counts(conn):
+    """Count the rows in each table of a db."""
+    tables = [name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                                             "AND name NOT LIKE 'sqlite_%'")]
+    return {table: conn.execute(f"SELECT COUNT(*) FROM [{table}]").fetchone()[0] for table in tables}
+
+def begin_staging(path):
+    """Start a staging db from a snapshot of the live db (if there is one), returning its path."""
+    staging = staging_path(path)
+    for suffix in ['', '-wal', '-shm', '-journal']:
+        if os.path.exists(f'{staging}{suffix}'):
+            os.remove(f'{staging}{suffix}')
+    if os.path.exists(path) and os.path.getsize(path):
+        with stage('snapshot', table=path):
+            with closing(sqlite3.connect(path)) as live, closing(sqlite3.connect(staging)) as copy:
+                live.backup(copy)
+    return staging
+
+def validate(path, staging):
+    """Check a staging db is fit to publish over the live db, raising a ValueError if it isn't.
+
+    Returns the row counts of the staging db's tables."""
+    with closing(sqlite3.connect(staging)) as conn:
+        check = conn.execute("PRAGMA quick_check").fetchone()[0]
+        if check != 'ok':
+            raise ValueError(f"The staging db {staging} failed its integrity check: {check}")
+        counts = table_counts(conn)
+    if os.path.exists(path) and os.path.getsize(path):
+        with closing(sqlite3.connect(f'file:{path}?mode=ro', uri=True)) as live:
+            before = table_counts(live)
+        lost = [table for table, rows in before.items() if rows and not counts.get(table)]
+        if lost:
+            raise ValueError(f"Tables missing or empty in the staging db {staging}: {', '.join(lost)}")
+    return counts
+
+def prepare(path, staging, analyze=True):
+    """Validate the staging db, and (unless it's already been done) analyse it for the query planner."""
+    with stage('validate', table=staging) as metric:
+        counts = validate(path, staging)
+        metric['rows'] = sum(counts.values())
+        if analyze:
+            with closing(sqlite3.connect(staging)) as conn:
+                conn.execute("ANALYZE")
+                conn.commit()
+
+def publish(path, staging):
+    """Swap the staging db in for the live db."""
+    os.replace(staging, path)
@@ -0,0 +1,172 @@
+"""Reading workbooks.
+
+The spreadsheets have a variable amount of metadata before the data, so we find where things are
+using labels in the sheet as cribs. Rather than comparing the whole sheet against each label in
+turn, we look up every label we're interested in in a single pass over the cells. The labels we
+use always live in the first few columns (and for some sheets, the first few rows), so only that
+part of the sheet is searched.
+
+Many of the sheets in the workbooks are charts, contents pages, or data we don't (yet) use.
+Rather than parse every sheet with `pd.read_excel(..., sheet_name=None)`, we check the sheet
+names first and only parse the sheets we want.
+
+The NHS sheets finish with a block of notes, so for those we can also stop reading a sheet as
+soon as we hit the `Notes:` marker after the table header. For `.xlsx` workbooks, rows are
+streamed from the file, so anything after the marker is never parsed at all. (Older `.xls`
+workbooks are read a sheet at a time, but a sheet has to be loaded in full.)
+
+Sheets are read untyped, since their headers have to be found first. As soon as they have been,
+the columns are given proper types from `sheet_dtypes` (see `typed_sheet()`): the labels become
+categories, the dates datetimes and the counts integers, so the frames are a fraction of the size
+and everything downstream works on native arrays rather than Python objects.
+
+Workbooks are read straight from the downloaded buffer, without copying it or writing it out to
+a file first. Some sources are published as a zip bundle holding the workbook, and those are
+unzipped in memory.
+"""
+import zipfile
+
+import numpy as np
+import pandas as pd
+from pandas.io.parsers import TextParser
+
+from .dates import normalise_dates
+from .sources import BufferReader, read_body
+
+# The types of the label and date columns of each kind of sheet, by sheet alias (see `nhs`) or
+# feed. Any other column holds counts.
+sheet_dtypes = {
+    'deaths by trust': {'NHS England Region': 'category', 'Code': 'category', 'Name': 'category',
+                        'Published': 'datetime'},
+    'deaths by age': {'Age group': 'category', 'Published': 'datetime'},
+    'deaths by region': {'NHS England Region': 'category', 'Published': 'datetime'},
+    'deaths by ethnicity': {'Ethnic group': 'category', 'Published': 'datetime'},
+    'deaths by gender': {'Age group': 'category', 'Gender': 'category', 'Published': 'datetime'},
+    'deaths by condition': {'Published': 'datetime'},
+    'ons weekly': {'Age': 'category'},
+    'ons death registrations': {'Area code': 'category', 'Geography type': 'category',
+                                'Area name': 'category', 'Cause of death': 'category',
+                                'Place of death': 'category'},
+}
+
+ANCHOR_MAX_COLS = 10
+ANCHOR_MAX_ROWS = 50
+
+def anchor_index(df, labels, max_rows=None, max_cols=ANCHOR_MAX_COLS):
+    """Find the cells holding any of the labels.
+
+    Returns a dict mapping each label to (rows, cols) arrays of the
+    positions where it was found, in the same order as np.where."""
+    block = df.iloc[:max_rows, :max_cols].to_numpy(dtype=object)
+    codes = pd.Index(labels).get_indexer(block.ravel()).reshape(block.shape)
+    rows, cols = np.nonzero(codes >= 0)
+    found = codes[rows, cols]
+    return {label: (rows[found == i], cols[found == i]) for i, label in enumerate(labels)}
+
+def _xlsx_cell(cell):
+    """Convert a cell value the same way pandas.read_excel does."""
+    from openpyxl.cell.cell import TYPE_ERROR, TYPE_NUMERIC
+    if cell.value is None:
+        return ''
+    elif cell.data_type == TYPE_ERROR:
+        return np.nan
+    elif cell.data_type == TYPE_NUMERIC and int(cell.value) == cell.value:
+        return int(cell.value)
+    return cell.value
+
+def _xlsx_rows(ws, stop_at=None, stop_after=()):
+    """Stream the rows of a worksheet.
+
+    Reading stops after the first row containing the stop_at marker that
+    follows a row containing one of the stop_after labels (if given)."""
+    ws.reset_dimensions()
+    data = []
+    armed = not stop_after
+    for row in ws.rows:
+        row = [_xlsx_cell(cell) for cell in row]
+        while row and row[-1] == '':
+            row.pop()
+        data.append(row)
+        if stop_at is None:
+            continue
+        leading = row[:ANCHOR_MAX_COLS]
+        if armed and stop_at in leading:
+            break
+        armed = armed or any(label in leading for label in stop_after)
+    while data and not data[-1]:
+        data.pop()
+    width = max((len(row) for row in data), default=0)
+    return [row + [''] * (width - len(row)) for row in data]
+
+def typed_sheet(df, dtypes):
+    """Set the types of the columns of a sheet whose header has been found.
+
+    `dtypes` maps column names to `category` or `datetime`. Any other column is a count, and
+    becomes a (nullable) integer column if it only holds whole numbers; columns that hold
+    anything else are left as they are."""
+    df = df.copy()
+    for i, c in enumerate(df.columns):
+        column = df.iloc[:, i]
+        kind = dtypes.get(c) if isinstance(c, str) else None
+        if kind == 'category':
+            column = column.astype('category')
+        elif kind == 'datetime':
+            try:
+                column = normalise_dates(column)
+            except (TypeError, ValueError):
+                continue
+        elif kind is None and column.dtype.kind in 'Ofi':
+            try:
+                numbers = pd.to_numeric(column)
+            except (TypeError, ValueError):
+                continue
+            if numbers.dtype.kind == 'f' and not (numbers.dropna() % 1 == 0).all():
+                continue
+            column = numbers.astype('Int64')
+        df.isetitem(i, column)
+    return df
+
+def workbook_content(content):
+    """Get the workbook from a source's content, unzipping it if it's a zip bundle.
+
+    An `.xlsx` workbook is itself a zip file, so it's only unzipped if it isn't one."""
+    if content[:2] != b'PK':
+        return content
+    with BufferReader(content) as f, zipfile.ZipFile(f) as bundle:
+        names = bundle.namelist()
+        if '[Content_Types].xml' in names:
+            return content
+        for name in names:
+            if name.lower().endswith(('.xlsx', '.xlsm', '.xls')):
+                with bundle.open(name) as member:
+                    return read_body(member, bundle.getinfo(name).file_size)
+    raise ValueError("No workbook in the zip bundle")
+
+def read_sheets(content, wanted=None, stop_at=None, stop_after=()):
+    """Parse the wanted sheets of a workbook (or a zip bundle holding one).
+
+    Returns the names of all the sheets in the workbook, and a dict of
+    dataframes for the sheets that were parsed (all of them, if wanted is None)."""
+    sheets = {}
+    content = workbook_content(content)
+    if content[:2] == b'PK':
+        import openpyxl
+        f = BufferReader(content)
+        wb = openpyxl.load_workbook(f, read_only=True, data_only=True)
+        try:
+            names = wb.sheetnames
+            for name in names:
+                if wanted is not None and name not in wanted:
+                    continue
+                rows = _xlsx_rows(wb[name], stop_at, stop_after)
+                # Use the first row as the header, as read_excel does by default
+                sheets[name] = TextParser(rows, header=0).read() if rows else pd.DataFrame()
+        finally:
+            wb.close()
+            f.close()
+    else:
+        import xlrd
+        book = xlrd.open_workbook(file_contents=content, on_demand=True)
+        names = book.sheet_names()
+        sheets = pd.read_excel(book, sheet_name=[name for name in names if wanted is None or name in wanted])
+    return names, sheets
@@ -0,0 +1,240 @@
+"""Fetching sources via the ledger.
+
+The `processed` table is a ledger of every source file we have ingested. For each source it
+records the URL, the link text it was found under, a hash of the downloaded bytes, the HTTP
+validators (ETag / Last-Modified) and the row ranges it added to each table. If we've seen a
+source before, we make a conditional request using the validators we stored for it; if the
+server doesn't support those, we fall back to comparing a hash of the downloaded bytes.
+"""
+import os
+import io
+import json
+import hashlib
+import datetime
+from collections import namedtuple
+
+import sqlite_utils
+
+from . import db
+from .http_cache import http_cache_get, http_cache_open
+from .metrics import stage
+
+DOWNLOAD_WORKERS = int(os.environ.get('NHS_DOWNLOAD_WORKERS', 8))
+
+Source = namedtuple('Source', ['reference', 'link_text', 'url', 'content',
+                               'sha256', 'etag', 'last_modified'])
+
+def ledger_entry(reference):
+    """Get the ledger record for a source, or None if we haven't seen it."""
+    try:
+        return db.DB['processed'].get(reference)
+    except sqlite_utils.db.NotFoundError:
+        return None
+
+def conditional_headers(url, seen):
+    """Build the headers for a conditional request from a ledger entry."""
+    headers = {}
+    if seen and seen['url'] == url:
+        if seen['etag']:
+            headers['If-None-Match'] = seen['etag']
+        if seen['last_modified']:
+            headers['If-Modified-Since'] = seen['last_modified']
+    return headers
+
+def download_source(reference, url, link_text=None, seen=None):
+    """Download a source, making a conditional request if we have a ledger entry for it.
+
+    The content is None if the server says the source is not modified. If the source has
+    already been downloaded by `prefetch_source()`, that download is used.
+    This doesn't touch the db, so it's safe to call from worker threads."""
+    src = prefetched.pop((reference, url), None)
+    if src is not None:
+        return src
+    with stage('download', reference) as metric:
+        r, body = http_cache_open(url, headers=conditional_headers(url, seen))
+        etag, last_modified = r.headers.get('ETag'), r.headers.get('Last-Modified')
+        if r.status_code == 304:
+            metric['bytes'] = 0
+            return Source(reference, link_text, url, None, None, etag, last_modified)
+        r.raise_for_status()
+        with HashingReader(body) as body:
+            content = read_body(body, r.headers.get('Content-Length'))
+        metric['bytes'] = len(content)
+    return Source(reference, link_text, url, content, body.sha256.hexdigest(), etag, last_modified)
+
+prefetched = {}
+
+def prefetch_source(reference, url, link_text=None, seen=None):
+    """Download a source ahead of time, for `download_source()` to pick up later.
+
+    If the download fails, it's left for `download_source()` to try again (and report)."""
+    try:
+        prefetched[(reference, url)] = download_source(reference, url, link_text, seen)
+    except Exception as e:
+        print(f"Couldn't prefetch {reference}: {e}")
+
+class HashingReader(io.RawIOBase):
+    """Wrap a binary file object, hashing the bytes as they are read."""
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.f.readinto(b)
+        self.sha256.update(memoryview(b)[:n])
+        self.size += n
+        return n
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+def read_body(body, size_hint=None, chunk_size=1024 ** 2):
+    """Read a binary stream to the end, straight into a single buffer.
+
+    Returns a `bytearray` holding exactly the bytes read. `size_hint` (the Content-Length,
+    say) is only used to size the buffer up front; it grows as needed."""
+    buffer = bytearray(int(size_hint or 0) or chunk_size)
+    scratch = bytearray(8192)
+    n = 0
+    while True:
+        if n == len(buffer):
+            # The buffer's full (as it will be when the size hint is exact), so check for the end
+            # with a small read before growing it, which can mean copying the whole download
+            got = body.readinto(scratch)
+            if not got:
+                break
+            with memoryview(scratch)[:got] as head:
+                buffer += head
+            n += got
+            buffer.extend(bytes(max(chunk_size, n // 2)))
+            continue
+        with memoryview(buffer)[n:] as tail:
+            got = body.readinto(tail)
+        if not got:
+            break
+        n += got
+    del buffer[n:]
+    return buffer
+
+class BufferReader(io.RawIOBase):
+    """A seekable binary file over a buffer (such as a downloaded source's content).
+
+    Unlike `io.BytesIO`, this never copies the buffer up front, whatever its type."""
+    def __init__(self, buffer):
+        self.view = memoryview(buffer).cast('B')
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self.view) - self.pos)
+        b[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def read(self, size=-1):
+        end = len(self.view) if size is None or size < 0 else min(self.pos + size, len(self.view))
+        data = self.view[self.pos:end].tobytes()
+        self.pos = max(self.pos, end)
+        return data
+
+    readall = read
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        start = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: len(self.view)}[whence]
+        self.pos = max(0, start + offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.view.release()
+        super().close()
+
+def stream_source(reference, url, link_text=None, seen=None):
+    """Open a source for streaming, making a conditional request if we have a ledger entry for it.
+
+    Returns the source, without its content or hash, and a `HashingReader` for its body.
+    The body is None if the source is not modified (a 304, or the same ETag as last time);
+    otherwise, once it has been read to the end, its hash can be filled in with
+    `src._replace(sha256=...)`."""
+    r, body = http_cache_open(url, headers=conditional_headers(url, seen))
+    src = Source(reference, link_text, url, None, None, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+    if r.status_code == 304 or (src.etag and seen and seen['url'] == url and seen['etag'] == src.etag):
+        if body is not None:
+            body.close()
+        return src, None
+    r.raise_for_status()
+    return src, HashingReader(body)
+
+def changed_source(src, seen):
+    """Return a downloaded source, or None if it is unchanged from the ledger entry."""
+    if src.sha256 is None:
+        print(f"Unchanged (not modified): {src.reference}")
+        return None
+    if seen and seen['sha256'] == src.sha256:
+        print(f"Unchanged (same content): {src.reference}")
+        # Keep the validators fresh so next time we can skip the download
+        db.DB.execute("UPDATE processed SET url = ?, etag = ?, last_modified = ? WHERE reference = ?",
+                      [src.url, src.etag, src.last_modified, src.reference])
+        return None
+    return src
+
+def fetch_source(reference, url, link_text=None):
+    """Download a source, or return None if it is unchanged since we last ingested it."""
+    seen = ledger_entry(reference)
+    return changed_source(download_source(reference, url, link_text, seen), seen)
+
+def forget_source(reference):
+    """Remove the rows added by the previously ingested version of a source."""
+    seen = ledger_entry(reference)
+    if not seen or not seen['tables']:
+        return
+    for table, ranges in json.loads(seen['tables']).items():
+        if not db.DB[table].exists():
+            continue
+        for start, end in ranges:
+            db.DB.execute(f"DELETE FROM [{table}] WHERE rowid BETWEEN ? AND ?", [start, end])
+
+def record_source(source, produced):
+    """Add a source, and the rows it produced, to the ledger."""
+    db.DB.execute("INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                  [source.reference, source.link_text, source.url, source.sha256,
+                   source.etag, source.last_modified, json.dumps(produced),
+                   datetime.datetime.utcnow().isoformat()])
+
+def processed_references():
+    """Get the references of the sources in the ledger."""
+    return [row['reference'] for row in db.DB['processed'].rows]
+
+def ledger_entries():
+    """Get all the ledger records, by reference."""
+    return {row['reference']: row for row in db.DB['processed'].rows}
+
+scraped = {}
+
+def scrape(url, parse_only=None):
+    """Fetch and parse an HTML page, unless we've already scraped it during this run.
+
+    Only the tags matching `parse_only` (the arguments for a `SoupStrainer`) are parsed."""
+    if url in scraped:
+        return scraped[url]
+    from bs4 import BeautifulSoup, SoupStrainer
+    with stage('scrape', url) as metric:
+        page = http_cache_get(url)
+        page.raise_for_status()
+        strainer = SoupStrainer(**parse_only) if parse_only else None
+        soup = BeautifulSoup(page.text, 'lxml', parse_only=strainer)
+        metric['bytes'] = len(page.content)
+    scraped[url] = soup
+    return soup
@@ -18,31 +18,32 @@
 #
 # Via: https://www.england.nhs.uk/statistics/statistical-work-areas/covid-19-daily-deaths/
 #
-# At the moment, each time this script runs it downloads all the daily datafiles and builds the db from scratch. We need to optimise things so that only new daily files are parsed and added, incrementally, to the database.
+# The database is built incrementally: the `processed` table is a ledger of every source file we have ingested. For each source it records the URL, the link text it was found under, a hash of the downloaded bytes, the HTTP validators (ETag / Last-Modified) and the row ranges it added to each table. Sources that are unchanged are skipped, so only new or updated files are downloaded, parsed and added to the database.
+#
+# To rebuild everything from scratch, just delete `nhs_dailies.db` before running the script.
+#
+# The code lives in the `uk_coronavirus_deaths` package, with a module for each feed (`nhs`, `ons_weekly`, `ons_registrations` and `phe`) and modules for the shared machinery: the HTTP cache (`http_cache`), the ledger (`sources`), reading workbooks (`sheets`, `dates`), writing to the database (`db`, `normalised`), the reporting lag aggregates (`aggregates`), indexes (`indexes`), the Parquet export (`parquet_export`) and the run metrics (`metrics`). This notebook runs the pipeline a step at a time, previewing the data as it goes. To run it all from the command line (or just some of the sources or stages), use `python -m uk_coronavirus_deaths --help`.
+#
+# Each stage of the pipeline is timed, noting the bytes and rows it handled and the peak memory use of the process so far. At the end of the run the metrics are added to the `run_metrics` table, and a summary is written to `RUN_METRICS_JSON` (`run_metrics.json` by default).
 
 # +
-import sqlite_utils
+import json
+
+import pandas as pd
+
+from uk_coronavirus_deaths import db, pipeline
+
 # #!rm nhs_dailies.db
-DB = sqlite_utils.Database("nhs_dailies.db")
-processed = DB['processed']
-# Start on a mechanism for only downloading things we haven't already grabbed
-# Need a better way to handle query onto table if it doesn't exist yet
-try:
-    already_processed = pd.read_sql("SELECT * FROM processed", DB.conn)['reference'].to_list()
-except:
-    already_processed = []
-    
-print("already processed", already_processed)
+DB = db.connect("nhs_dailies.db")
 # -
 
-# Load the page:
-
-import requests
+# The database is set up for fast loading, and each source is committed along with its ledger entry as soon as it has been ingested, so a run that dies part way through can pick up where it left off. Everything is fetched through an on-disk HTTP cache (`HTTP_CACHE_DIR`, `.http_cache` by default); setting `HTTP_CACHE_OFFLINE=1` replays a run from the cache without touching the network. The frames parsed from each workbook are cached too (`PARSE_CACHE_DIR`, `.parse_cache` by default), keyed on the workbook's hash, so rebuilding the database from scratch doesn't parse anything twice.
 
-from bs4 import BeautifulSoup, SoupStrainer
+db.begin_bulk_load()
 
+# The landing pages of the sources are scraped concurrently, and each source is downloaded as soon as it's found, ready for it to be ingested below:
 
-# Get the HTML page data into a form we can scrape it:
+pipeline.discover(list(pipeline.SOURCES))
 
 # ## ONS
 #
@@ -53,263 +54,40 @@ from bs4 import BeautifulSoup, SoupStrainer
 #
 
 # ### Weekly deaths, ONS:
+#
+# The workbook has sheets for weekly registrations, occurrences and all-cause mortality. Each of them is reshaped into long form and added to the `ons_deaths` table, replacing any rows from a previous version of the workbook. The workbook is only grabbed if it has changed since we last ingested it.
 
-import requests
-import pandas as pd
-from bs4 import BeautifulSoup, SoupStrainer
-import numpy as np
-
-base='https://www.ons.gov.uk/peoplepopulationandcommunity/birthsdeathsandmarriages/deaths/datasets/weeklyprovisionalfiguresondeathsregisteredinenglandandwales'
-page = requests.get(base, allow_redirects=True)
-soup = BeautifulSoup(page.text, 'lxml')
-links = {}
-lahtable_link = ''
-for link in soup.find_all('a'):
-    if 'Download Deaths registered weekly' in link.text:
-        lahtable_link = link.get('href')
-        break
-weeklytable_file = lahtable_link#.split('/')[-1]
-weeklytable_file
-
-ons_weekly_url = f'https://www.ons.gov.uk{weeklytable_file}'
-print(ons_weekly_url)
-
-
-# +
-r = requests.get(ons_weekly_url)
-
-fn = ons_weekly_url.split('/')[-1]
-
-print('Writing file...')
-with open(fn, 'wb') as f:
-    f.write(r.content)
-print('File written...')
-try:
-    ons_sheets = pd.read_excel(fn, sheet_name=None)
-except:
-    with open(fn) as f:
-        print(f.read())
-# What sheets are available in the spreadsheet
-ons_sheet_names = ons_sheets.keys()
-ons_sheet_names
-# -
-
-print('To here 1..')
-ons_weekly_reg = ons_sheets['Covid-19 - Weekly registrations']
-ons_weekly_reg.head()
-
-print('To here 2..')
-ons_weekly_occ = ons_sheets['Covid-19 - Weekly occurrences']
-print(ons_weekly_occ.head())
-
-print('To here 3..')
-def ons_weeklies(ons_weekly, typ):
-    ons_weekly_long = {}
-    rows, cols = np.where(ons_weekly == 'Week ended')
-    colnames = ons_weekly.iloc[rows[0]].tolist()
-    colnames[1] = 'Age'
-    print('to A')
-    rows, cols = np.where(ons_weekly == 'Deaths by age group')
-    print('to B', rows, cols)
-    _rows, _ = np.where(ons_weekly == '90+')
-    _ix = rows[0]
-    print('to C', _rows)
-    tables = []
-
-
-    #Get the first three tables - for Persons, Males and Females
-    for r, c in zip(rows, cols):
-        tables.append(ons_weekly.iloc[r-1, c].split()[0])
-    print('to D')
-    for r, _r, t in zip(rows, _rows, tables):
-        ons_weekly_long[t] = ons_weekly.iloc[r+1: _r+1]
-        ons_weekly_long[t].columns = colnames
-        ons_weekly_long[t].dropna(axis=1, how='all', inplace=True)
-        dropper = [c for c in ons_weekly_long[t].columns if 'to date' in str(c)]
-        dropper = dropper + [c for c in ons_weekly_long[t].columns if '1 to' in str(c)]
-        print('to E', r, _r, t, dropper)
-        if dropper:
-            ons_weekly_long[t].drop(columns=dropper, inplace=True)
-        ons_weekly_long[t] = ons_weekly_long[t].melt(id_vars=['Age'], var_name='Date', value_name='value')
-        ons_weekly_long[t]['measure'] = typ
-        print(ons_weekly_long[t])
-        ons_weekly_long[t]['Date'] = pd.to_datetime(ons_weekly_long[t]['Date'])
-    print('to F', tables)
-    ons_weekly_long['Any'] = pd.DataFrame()
-    for t in tables:
-        ons_weekly_long[t]['Group'] = t
-        ons_weekly_long['Any'] = pd.concat([ons_weekly_long['Any'], ons_weekly_long[t]])
-    print('to F')
-    ons_weekly_long['Any'].reset_index(inplace=True, drop=True)
-    
-    return ons_weekly_long
-
-print('To here 4..')
-ons_weekly_reg_long = ons_weeklies(ons_weekly_reg, 'Weekly registrations')
-ons_weekly_reg_long['Females']
-
-# + tags=["active-ipynb"]
-# ons_weekly_reg_long['Any']
-
-# + tags=["active-ipynb"]
-# ons_weekly_occ
-# -
-
-print('To here 5..')
-ons_weekly_occ_long = ons_weeklies(ons_weekly_occ, 'Weekly occurrences')
-ons_weekly_occ_long['Males']
-
-print('To here 6..')
-ons_weekly_all = ons_sheets['Weekly figures 2020']
-ons_weekly_all.head()
-
-print('To here 7..')
-ons_weekly_all_long = ons_weeklies(ons_weekly_all, 'Weekly all mortality')
-ons_weekly_all_long['Males']
-
-# Add to database...
+pipeline.ingest('ons-weekly')
 
-# +
-print('To here 8..')
-_table = 'ons_deaths'
-
-ons_weekly_occ_long['Any'].to_sql(_table, DB.conn, index=False, if_exists='append')
-print('To here 9..')
-ons_weekly_reg_long['Any'].to_sql(_table, DB.conn, index=False, if_exists='append')
-print('To here 10..')
-ons_weekly_all_long['Any'].to_sql(_table, DB.conn, index=False, if_exists='append')
-print('To here 11..')
+# + tags=["active-ipynb"]
+# pd.read_sql("SELECT * FROM ons_deaths LIMIT 5", DB.conn)
 # -
 
 # ### ONS Death Registrations, 2020
 #
 # https://www.ons.gov.uk/peoplepopulationandcommunity/healthandsocialcare/causesofdeath/datasets/deathregistrationsandoccurrencesbylocalauthorityandhealthboard
+#
+# Each release is upserted into the `ons_deaths_reg` and `ons_deaths_reg_occ` tables.
 
-print('To here 12..')
-base='https://www.ons.gov.uk/peoplepopulationandcommunity/healthandsocialcare/causesofdeath/datasets/deathregistrationsandoccurrencesbylocalauthorityandhealthboard'
-page = requests.get(base, allow_redirects=True)
-soup = BeautifulSoup(page.text, 'lxml')
-links = {}
-lahtable_link = ''
-for link in soup.find_all('a'):
-    if 'Download Death registrations and occurrences' in link.text:
-        lahtable_link = link.get('href')
-        break
-lahtable_file = lahtable_link#.split('/')[-1]
-lahtable_file
-
-print('To here 13..')
-ons_death_reg_url = f'https://www.ons.gov.uk{lahtable_file}'
-ons_death_reg_url
-
-# +
-print('To here 14..')
-r = requests.get(ons_death_reg_url, allow_redirects=True)
-
-fn = ons_death_reg_url.split('/')[-1]
- 
-with open(fn, 'wb') as f:
-    f.write(r.content)
-
-ons_reg_sheets = pd.read_excel(fn, sheet_name=None)
-
-# What sheets are available in the spreadsheet
-ons_reg_sheet_names = ons_reg_sheets.keys()
-ons_reg_sheet_names
-# -
-
-print('To here 15..')
-ons_death_reg = ons_reg_sheets['Registrations - All data']
-ons_death_reg_metadata = ons_death_reg.iloc[0, 0]
-ons_death_reg_metadata
-
-# +
-print('To here 16..')
-from parse import parse
-import dateparser
-
-upto = parse('Deaths (numbers) by local authority and cause of death, registered up to the {date}, England and Wales',
-             ons_death_reg_metadata)['date']
-upto = dateparser.parse(upto)
-
-rows, cols = np.where(ons_death_reg == 'Area code')
-colnames = ons_death_reg.iloc[rows[0]].tolist()
-    
-ons_death_reg = ons_death_reg.iloc[rows[0]+1:].reset_index(drop=True)
-ons_death_reg.columns = colnames
-
-
-ons_death_reg['Registered up to'] = upto
-ons_death_reg
-
-# +
-print('To here 17..')
-ons_death_occ = ons_reg_sheets['Occurrences - All data']
-ons_death_occ_metadata = ons_death_occ.iloc[0, 0]
-ons_death_occ_metadata
-
-uptos = parse('Deaths (numbers) by local authority and cause of death, for deaths that occurred up to {date_occ} but were registered up to {date_reg}, England and Wales',
-             ons_death_occ_metadata)
-
-upto_occ = uptos['date_occ']
-if '2020' not in upto_occ: upto_occ = f'{upto_occ} 2020'
-    
-upto_reg = uptos['date_reg']
-if '2020' not in upto_occ: upto_occ = f'{upto_reg} 2020'
-
-upto_occ = dateparser.parse(upto_occ)
-upto_reg = dateparser.parse(upto_reg)
-
-rows, cols = np.where(ons_death_occ == 'Area code')
-colnames = ons_death_occ.iloc[rows[0]].tolist()
-    
-ons_death_occ = ons_death_occ.iloc[rows[0]+1:].reset_index(drop=True)
-ons_death_occ.columns = colnames
-
+pipeline.ingest('ons-registrations')
 
-ons_death_occ['Occurred up to'] = upto_occ
-ons_death_occ['Registered up to'] = upto_reg
-ons_death_occ
+# + tags=["active-ipynb"]
+# pd.read_sql("SELECT * FROM ons_deaths_reg_occ LIMIT 5", DB.conn)
 # -
 
-print('To here 18..')
-_table = 'ons_deaths_reg'
-ons_death_reg.to_sql(_table, DB.conn, index=False, if_exists='replace')
-print('To here 19..')
-_table = 'ons_deaths_reg_occ'
-ons_death_occ.to_sql(_table, DB.conn, index=False, if_exists='replace')
-print('To here 20..')
-
 # ## NHS stuff
 #
-# Get the links...
-
 # Daily reports are published as an Excel spreadhseet linked from the following page:
-
-# Reporting page
-url = 'https://www.england.nhs.uk/statistics/statistical-work-areas/covid-19-daily-deaths/'
-
-page = requests.get(url)
-soup = BeautifulSoup(page.text)
-
+#
+# https://www.england.nhs.uk/statistics/statistical-work-areas/covid-19-daily-deaths/
+#
 # Get the relevant links to the daily spreadseets:
 
-already_processed
-
-links = {}
-for link in soup.find("article", {"class": "rich-text"}).find_all('a'):
-    if link.text.startswith('COVID 19 daily announced deaths'):
-        if link.text not in links:
-            links[link.text] = link.get('href')
-    elif link.text.startswith('COVID 19 total announced deaths') and link.text.endswith('weekly tables'):
-        weekly_totals_link =  link.get('href')
-    elif link.text.startswith('COVID 19 total announced deaths'):
-        totals_link =  link.get('href')
-links = {l:links[l] for l in links if l not in already_processed}
-links
-
-import numpy as np
-import pandas as pd
+# +
+from uk_coronavirus_deaths import nhs
+
+links = nhs.nhs_links()[0]
+# -
 
 # Start to sketch out how we can parse the data out of one of the spreadsheets. The following has been arrivied though a little bit of iteration an previewing of the data:
 
@@ -407,194 +185,29 @@ import pandas as pd
 # sheets[sheet].head()
 # -
 
-# Sheet names keep changing, so create a lookup of aliases that we can normalise into.
-#
-# Some of the `ignore` sheets should be treated as "ignore for now" - there is data we can scrape but it may not be in a form currently handled.
-
-sheet_aliases = {
-    'COVID19 daily deaths by age': 'deaths by age',
-    'COVID19 daily deaths by region': 'deaths by region',
-    'COVID19 daily deaths by trust': 'deaths by trust',
-    # TO DO - could the totals as well as daily sheet move to this convention?
-    'Tab1 Deaths by region': 'deaths by region', 
-    'Tab2 Deaths - no pos test': 'ignore', 
-    'Tab3 Deaths by age': 'deaths by age',
-    'Tab4 Deaths by trust': 'deaths by trust',
-    'Contents': 'ignore',
-    'Fig1 Daily deaths': 'ignore',
-    'COVID19 daily deaths chart': 'ignore',
-    'Deaths by region- no pos test ':  'ignore',
-    'Deaths by region-negative test ': 'ignore',
-    'Deaths by region - no pos test ':  'ignore',
-    'COVID19 total deaths chart': 'ignore',
-    'COVID19 total deaths by trust': 'deaths by trust',
-    'COVID19 total deaths by region': 'deaths by region',
-    'COVID19 total deaths by age': 'deaths by age',
-    'COVID19 all deaths by ethnicity': 'deaths by ethnicity',
-    'COVID19 all deaths by gender': 'deaths by gender',
-    'COVID19 all deaths by condition': 'ignore',
-    'Tab1 Deaths by ethnicity': 'deaths by ethnicity',
-    'Tab2 Deaths by gender': 'deaths by gender', 
-    'Tab3 Deaths by condition': 'ignore',
-    'Tab4 Deaths by cond (detail)': 'deaths by condition'
-}
-
-
-# The following tries to clean things automatically - we drop the national aggregate values:
-
-# +
-# Should work for:
-#COVID19 total deaths by trust
-#COVID19 total deaths by region
-#COVID19 total deaths by age
-#COVID19 all deaths by ethnicity
-#COVID19 all deaths by gender
-
-# Currently excludes:
-#COVID19 total deaths chart
-#Deaths by region - no pos test
-#COVID19 all deaths by condition
-
-def cleaner(sheets):
-    print('Entering cleaner...')
-    for sheet in sheets:
-        print(f"Trying sheet...{sheet}")
-        #if 'chart' in sheet or 'no pos' in sheet or 'condition' in sheet:
-        #    continue
-        if sheet not in sheet_aliases or sheet_aliases[sheet]=='ignore':
-            continue
-        rows, cols = np.where(sheets[sheet] == 'Published:')
-        published_date = sheets[sheet].iat[rows[0], cols[0]+1]
-
-        if 'age' in sheet or 'gender' in sheet_aliases[sheet]:
-            rows, cols = np.where(sheets[sheet] == 'Age group')
-            #print((rows, cols))
-            _ix= rows[0]
-        elif 'ethnicity' in sheet_aliases[sheet]:
-            rows, cols = np.where(sheets[sheet] == 'Ethnic group')
-            #print((rows, cols))
-            _ix= rows[0]
-        elif 'condition' in sheet_aliases[sheet]:
-            rows, cols = np.where(sheets[sheet] == 'Date introduced')
-            _ix= rows[0]
-        else:
-            rows, cols = np.where(sheets[sheet] == 'NHS England Region')
-            #print((sheet, rows, cols))
-            _ix= rows[0] #ix[sheet][0]
-        colnames = sheets[sheet].iloc[_ix]
-        sheets[sheet] = sheets[sheet].iloc[_ix+3:]
-        sheets[sheet].columns = colnames
-        sheets[sheet].dropna(axis=1, how='all', inplace=True)
-        sheets[sheet].dropna(axis=0, how='all', inplace=True)
-        sheets[sheet] = sheets[sheet].loc[:, sheets[sheet].columns.notnull()]
-        #display(f'Checking: {sheet}')
-        sheets[sheet]['Published'] = published_date
-        sheets[sheet].reset_index(inplace=True, drop=True)
-
-        # Drop lines after Notes
-        rows, cols = np.where(sheets[sheet] == 'Notes:')
-
-        if rows:
-            sheets[sheet].drop(sheets[sheet].index[rows[0]:], inplace=True)
-         #sheets[sheet].dropna(axis=0, subset=[sheets[sheet].columns[0]], inplace=True)
-
-    return sheets
-
-
-# -
-
-# Grab all the daily reports:
-
-# +
-data = {}
-
-tabs = []
-for link in links:
-    if link in already_processed:
-        continue
-    try:
-        sheets = pd.read_excel(links[link], sheet_name=None)
-
-        for k in sheets.keys():
-            if k not in tabs:
-                tabs.append(k)
-        sheets = cleaner(sheets)
-
-        data[link] = sheets
-
-        processed.insert({"reference": link})
-
-    except:
-        print("Broke with sheets:", sheets.keys())
-        #exit(-1)
-
-
-# + tags=["active-ipynb"]
-# tabs
+# Sheet names keep changing, so `nhs.sheet_aliases` is a lookup of aliases that we can normalise into, and `nhs.cleaner()` uses cribs such as these to clean the sheets automatically.
+#
+# Grab all the daily reports. Each daily report is published once under its own link, so the link text is used as its ledger reference and any we have already processed are skipped. They are fetched concurrently: downloads run in a pool of threads, and parsing and cleaning the workbooks in a pool of processes (set the pool sizes with `NHS_DOWNLOAD_WORKERS` and `NHS_PARSE_WORKERS`).
 
-# + tags=["active-ipynb"]
-# data.keys()
-# -
+pipeline.ingest('nhs-dailies')
 
 # Just as an aside, we can informally extract the publication date of a spreadheet from the associated link text on the original web page (trusting that the link does refer to the correctly linked document):
 
-# +
-from parse import parse
-import dateparser
-
-def getLinkDate(link):
-    """Get date from link text."""
-    _date = parse('COVID 19 daily announced deaths {date}', link)['date']
-    return dateparser.parse(_date)
-
-
 # + tags=["active-ipynb"]
 # #Test the date extractor
-# getLinkDate('COVID 19 daily announced deaths 15 April 2020')
-
-# + tags=["active-ipynb"]
-# data['COVID 19 daily announced deaths 9 April 2020'].keys()
+# nhs.getLinkDate('COVID 19 daily announced deaths 15 April 2020')
 # -
 
 # Preview what sort of data we've got:
 
 # + tags=["active-ipynb"]
-# df = data['COVID 19 daily announced deaths 9 April 2020']['COVID19 daily deaths by trust']
-# df
-# -
-
-# Preview a specific area, albeit with quite an informal search term:
-
-# + tags=["active-ipynb"]
-# df = data['COVID 19 daily announced deaths 4 April 2020']['COVID19 daily deaths by trust']
+# from uk_coronavirus_deaths.sources import download_source
+#
+# _src = download_source('preview', links['COVID 19 daily announced deaths 9 April 2020'])
+# df = dict(nhs.parse_daily(_src.content)[0])['nhs_dailies_trust']
 # df[df['Name'].str.contains('WIGHT')]
 # -
 
-# Grab the totals:
-
-totals_xl = pd.read_excel(totals_link, sheet_name=None)
-totals_xl.keys()
-
-weekly_totals_xl =  pd.read_excel(weekly_totals_link, sheet_name=None)
-weekly_totals_xl.keys()
-
-# +
-#totals_xl['Tab4 Deaths by cond (detail)']
-# -
-
-totals_xl = cleaner(totals_xl)
-totals_xl.keys()
-
-weekly_totals_xl = cleaner(weekly_totals_xl)
-weekly_totals_xl.keys()
-
-totals_xl
-
-# + tags=["active-ipynb"]
-# #dfs = totals_xl['COVID19 total deaths by trust']
-# #dfs[dfs['Name'].str.contains('WIGHT')]
-# -
-
 # ## Adding NHS Daily Data to a Database
 #
 # The data is perhaps most easily managed in a long form. We could normalise the data properly across several tables, or for mow we can just grab perhaps slightly denormalised tables for the dates and separate tables for totals and result awaiting verification:
@@ -615,140 +228,23 @@ totals_xl
 # tmp.head()
 # -
 
-# Create a simple SQLite database:
-
-# Add the daily data to the db:
-
-# + tags=["active-ipynb"]
-# #df_long.head()
-
-# +
-idx = {'trust': ['NHS England Region','Code','Name', 'Published'],
-       'age': ['Age group', 'Published'],
-       'region': ['NHS England Region', 'Published'] }
-
-for daily in data.keys():
-    #print(daily)
-    #linkDate = getLinkDate(daily)
-    # TO DO - get data from excluded sheets
-    if daily in already_processed:
-        continue
-    for sheet in data[daily].keys():
-        if sheet not in sheet_aliases or sheet_aliases[sheet]=='ignore':
-            continue
-        #print(sheet)
-        table = parse('deaths by {table}', sheet_aliases[sheet])['table']
-        #print(f'Using table {table}')
-        df_dailies = data[daily][sheet].drop(columns=['Awaiting verification', 'Total'])
-        #df_dailies['Link_date'] = linkDate
-        idx_cols = idx[table]#+['Link_date']
-        df_long = df_dailies.melt(id_vars=idx_cols,
-                                  var_name='Date',
-                                  value_name='value')
-        df_long['Date'] = pd.to_datetime(df_long['Date'])
-        if df_long['Published'].dtype == 'O':
-            df_long['Published'] = df_long['Published'].apply(dateparser.parse)
-        df_long['lag'] = (df_long['Published'] - df_long['Date']).dt.days
-
-        _table = f'nhs_dailies_{table}'
-        df_long.to_sql(_table, DB.conn, index=False, if_exists='append')
-        
-        cols = idx[table] + ['Awaiting verification', 'Total']
-        data[daily][sheet][cols].to_sql(f'{_table}_summary',
-                                        DB.conn, index=False, if_exists='append')
-        
-    processed.insert({"reference": daily})
-# -
-
-# Dummy query on `age` sheet:
+# Each daily report is added to the db in long form, along with the summary columns:
 
 # + tags=["active-ipynb"]
 # pd.read_sql("SELECT * FROM nhs_dailies_age LIMIT 25", DB.conn)
-# -
-
-# Dummy query on `age_summary` sheet:
-
-# + tags=["active-ipynb"]
-# pd.read_sql("SELECT * FROM nhs_dailies_age_summary LIMIT 5", DB.conn)
-# -
-
-# Dummy query on `trust` sheet:
-
-# + tags=["active-ipynb"]
-# pd.read_sql("SELECT * FROM nhs_dailies_trust LIMIT 5", DB.conn)
-# -
-
-# Dummy query on `trust_summary` sheet:
 
 # + tags=["active-ipynb"]
 # pd.read_sql("SELECT * FROM nhs_dailies_trust_summary LIMIT 5", DB.conn)
-# -
-
-# Dummy query on `region` sheet:
 
 # + tags=["active-ipynb"]
 # pd.read_sql("SELECT * FROM nhs_dailies_region LIMIT 25", DB.conn)
 # -
 
-# Dummy query on `region_summary` sheet:
-
-# + tags=["active-ipynb"]
-# pd.read_sql("SELECT * FROM nhs_dailies_region_summary LIMIT 25", DB.conn)
-# -
-
 # ### Adding NHS Totals Data to Database
+#
+# The totals workbooks are republished under a new link each day, so they are tracked in the ledger under a fixed reference and only parsed if their content has changed. Any rows from the previous version of the workbook are replaced:
 
-# + tags=["active-ipynb"]
-# totals_xl.keys()
-# -
-
-for sheet in totals_xl.keys():
-    if sheet not in sheet_aliases or sheet_aliases[sheet]=='ignore':
-            continue
-    table = parse('deaths by {table}', sheet_aliases[sheet])['table']
-    _table = f'nhs_totals_{table}'
-    if 'ethnicity' not in table and 'gender' not in table and 'condition' not in table:
-        df_totals = totals_xl[sheet].drop(columns=['Awaiting verification', 'Total', 'Up to 01-Mar-20'])
-        idx_cols = idx[table]
-        df_long = df_totals.melt(id_vars=idx_cols,
-                                  var_name='Date',
-                                  value_name='value')
-        df_long['Date'] = pd.to_datetime(df_long['Date'])
-        if df_long['Published'].dtype == 'O':
-            df_long['Published'] = df_long['Published'].apply(dateparser.parse)
-        df_long['lag'] = (df_long['Published'] - df_long['Date']).dt.days
-
-        df_long.to_sql(_table, DB.conn, index=False, if_exists='append')
-
-        cols = idx_cols + ['Up to 01-Mar-20', 'Awaiting verification', 'Total']
-        totals_xl[sheet][cols].to_sql(f'{_table}_summary',
-                                        DB.conn, index=False, if_exists='append')
-    else:
-        totals_xl[sheet].to_sql(f'{_table}', DB.conn, index=False, if_exists='append')
-
-for sheet in weekly_totals_xl.keys():
-    if sheet not in sheet_aliases or sheet_aliases[sheet]=='ignore':
-            continue
-    table = parse('deaths by {table}', sheet_aliases[sheet])['table']
-    _table = f'nhs_weekly_totals_{table}'
-    if 'ethnicity' not in table and 'gender' not in table and 'condition' not in table:
-        df_totals = weekly_totals_xl[sheet].drop(columns=['Awaiting verification', 'Total', 'Up to 01-Mar-20'])
-        idx_cols = idx[table]
-        df_long = df_totals.melt(id_vars=idx_cols,
-                                  var_name='Date',
-                                  value_name='value')
-        df_long['Date'] = pd.to_datetime(df_long['Date'])
-        if df_long['Published'].dtype == 'O':
-            df_long['Published'] = df_long['Published'].apply(dateparser.parse)
-        df_long['lag'] = (df_long['Published'] - df_long['Date']).dt.days
-
-        df_long.to_sql(_table, DB.conn, index=False, if_exists='append')
-
-        cols = idx_cols + ['Up to 01-Mar-20', 'Awaiting verification', 'Total']
-        weekly_totals_xl[sheet][cols].to_sql(f'{_table}_summary',
-                                        DB.conn, index=False, if_exists='append')
-    else:
-        weekly_totals_xl[sheet].to_sql(f'{_table}', DB.conn, index=False, if_exists='append')
+pipeline.ingest('nhs-totals')
 
 # + tags=["active-ipynb"]
 # DB.table_names()
@@ -773,6 +269,18 @@ for sheet in weekly_totals_xl.keys():
 # + tags=["active-ipynb"]
 # pd.read_sql("SELECT value, lag FROM nhs_totals_trust WHERE Name='WEST HERTFORDSHIRE HOSPITALS NHS TRUST'", DB.conn).groupby(['lag']).sum().plot(kind='bar')
 # -
+# ### Reporting lag aggregates
+#
+# Rather than pulling the raw rows into pandas every time we want to look at reporting lags, the lag distributions of the daily announcements are materialised in the database (`nhs_lag_trust`, `nhs_lag_region` and `nhs_lag_age`), along with the lags by which 50%, 90% and 95% of each trust's (region's, age group's) deaths had been reported (`nhs_lag_trust_completeness` etc.). They're updated incrementally, with just the dailies published since they were last updated.
+
+pipeline.aggregate()
+
+# + tags=["active-ipynb"]
+# pd.read_sql("SELECT lag, deaths, cumulative_share FROM nhs_lag_trust WHERE Name='WEST HERTFORDSHIRE HOSPITALS NHS TRUST' ORDER BY lag", DB.conn).plot(x='lag', y='deaths', kind='bar')
+
+# + tags=["active-ipynb"]
+# pd.read_sql("SELECT * FROM nhs_lag_region_completeness", DB.conn)
+# -
 
 # ## Public Health England
 #
@@ -780,43 +288,54 @@ for sheet in weekly_totals_xl.keys():
 #     
 # - [Cases](https://coronavirus.data.gov.uk/downloads/csv/coronavirus-cases_latest.csv)
 # - [Deaths](https://coronavirus.data.gov.uk/downloads/csv/coronavirus-deaths_latest.csv)
+#
+# The national CSVs keep growing, so by default they're streamed into a staging table a chunk of rows at a time, and merged into the old table once the whole file has been read. Set `PHE_STREAMING=0` to read each CSV in one go instead.
 
 # +
-#via https://stackoverflow.com/questions/61415090/python-pandas-handling-of-308-request
-import requests
-import io
+phe_heads = pipeline.ingest('phe')
+
+if phe_heads['phe_cases'] is not None:
+    phe_heads['phe_cases'].head()
 
-def get_308_csv(url):
-    datastr = requests.get(url, allow_redirects=True).text
-    data_file = io.StringIO(datastr)
-    _df = pd.read_csv(data_file)
-    _df['Specimen date'] =  pd.to_datetime(_df['Specimen date'])
-    return _df
+# + tags=["active-ipynb"]
+# pd.read_sql("SELECT * FROM phe_cases LIMIT 3", DB.conn)
 
+# + tags=["active-ipynb"]
+# pd.read_sql("SELECT * FROM phe_deaths LIMIT 3", DB.conn)
+# -
 
-# +
-phe_cases_url = 'https://coronavirus.data.gov.uk/downloads/csv/coronavirus-cases_latest.csv'
-phe_cases_df = get_308_csv(phe_cases_url)
+# ## Finishing Up
+#
+# ### Indexes
+#
+# Add indexes for the ways the published database is queried via Datasette, along with full text search over trust and area names, and update the query planner statistics:
 
-_table = f'phe_cases'
-phe_cases_df.to_sql(_table, DB.conn, index=False, if_exists='replace')
-    
-phe_cases_df.head()
+pipeline.index()
 
-# + tags=["active-ipynb"]
-# pd.read_sql("SELECT * FROM phe_cases LIMIT 3", DB.conn)
+# Commit everything we've loaded, and compact the database before it's published:
 
-# +
-phe_deaths_url = 'https://coronavirus.data.gov.uk/downloads/csv/coronavirus-deaths_latest.csv'
-phe_deaths_df = get_308_csv(phe_cases_url)
+pipeline.finish()
 
-_table = f'phe_deaths'
-phe_cases_df.to_sql(_table, DB.conn, index=False, if_exists='replace')
+# ### Parquet export
+#
+# For analytic work, the tables that have changed are also exported as Parquet files in `PARQUET_DIR` (`parquet` by default; set it to an empty string to skip the export). The long NHS tables are partitioned by the month they were published in, and `ons_deaths` by measure, in hive style directories.
 
-phe_deaths_df.head()
+pipeline.export()
 
 # + tags=["active-ipynb"]
-# pd.read_sql("SELECT * FROM phe_deaths LIMIT 3", DB.conn)
+# pd.read_parquet('parquet/nhs_dailies_trust', filters=[('published_month', '=', '2020-04')], columns=['Name', 'Date', 'value', 'lag']).head()
+# -
+
+# ### Run metrics
+#
+# Save the metrics for this run. The summary totals up the time, bytes and rows for each kind of stage, and lists the slowest stages.
+
+# +
+from uk_coronavirus_deaths import metrics
+
+if metrics.RUN_METRICS_JSON:
+    run_summary = metrics.save_run_metrics()
+    print(json.dumps(run_summary['stages'], indent=2))
 # -
 
 # ### NHS - A&E
@@ -849,8 +368,9 @@ phe_deaths_df.head()
 # @register_line_magic
 # def phe_cases(line):
 #     "Query datasette."
+#     # Use the full text index on area names rather than a (slow) __contains match
 #     payload = {'_sort': 'rowid',
-#                'Area name__contains': line,
+#                '_search': line,
 #                '_size': 'max'}
 #     _url =  _datasette_url.format(urlencode(payload))
 #     return pd.read_csv( _url)
@@ -871,19 +391,12 @@ phe_deaths_df.head()
 
 # + tags=["active-ipynb"]
 # #https://techoverflow.net/2018/01/16/downloading-reading-a-zip-file-in-memory-using-python/
+# # The download is read straight into a buffer, and the zip file read from that buffer without copying it
 # import zipfile
+# from uk_coronavirus_deaths import ons_weekly
+# from uk_coronavirus_deaths.sources import BufferReader, download_source
 #
-# def download_extract_xml(url):
-#     """
-#     Download a ZIP file and extract its contents in memory
-#     yields (filename, file-like object) pairs
-#     """
-#     response = requests.get(url)
-#     with zipfile.ZipFile(io.BytesIO(response.content)) as thezip:
-#         for zipinfo in thezip.infolist():
-#             with thezip.open(zipinfo) as thefile:
-#                 yield zipinfo.filename, thefile
-#                 
-# r = download_extract_xml(ons_weekly_url)
-# for f in r:
-#     print(f)
+# src = download_source('ONS weekly deaths', ons_weekly.ons_weekly_link()[0])
+# with BufferReader(src.content) as f, zipfile.ZipFile(f) as thezip:
+#     for zipinfo in thezip.infolist():
+#         print(zipinfo.filename, zipinfo.file_size)